@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark đường nóng của core dùng chung (gti-control/app), không cần server/broker:
+API giả trả bản ghi dựng sẵn, coordinator chạy không có MQTT client.
+  python benchmarks/bench_core.py                # mặc định 200 device
+  python benchmarks/bench_core.py --devices 1000 --repeat 5
+"normalize+json" so sánh chuẩn hoá cũ (fmt2 + try/except trên dict, json.dumps)
+với DeviceState (array('d'), 1 lượt không exception, snapshot + to_json).
+Vì gti-control-debug/app là bản sync (scripts/sync_core.py), số đo áp dụng cho cả 2 add-on.
+"""
+
+from __future__ import annotations
+
+import argparse, json, os, random, sys, time
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gti-control", "app"))
+
+from api_client import _newest_row, parse_values  # noqa: E402
+from coordinator import Coordinator  # noqa: E402
+from mapping import GTI_SENSORS, GRID_SENSORS, TIEUTHU_SENSORS  # noqa: E402
+from rate_limiter import RateLimiter  # noqa: E402
+from sources import decode_payload  # noqa: E402
+from state_record import DeviceState, Layout, INSTANT_FIELDS, PERIOD_FIELDS  # noqa: E402
+from view_models import build_view  # noqa: E402
+import fleet_analytics  # noqa: E402
+
+SENSORS = list(GTI_SENSORS) + list(GRID_SENSORS) + list(TIEUTHU_SENSORS)
+PERIOD_KEYS = list(PERIOD_FIELDS)
+
+
+def _row(i: int, rnd: random.Random) -> Dict[str, Any]:
+    raw = {k: round(rnd.uniform(0, 500), 2) for k in SENSORS}
+    raw.update(deviceId=f"GTIControl{i}", updatedAt=f"2024-01-01T00:{i % 60:02d}:00Z")
+    return {"deviceId": raw["deviceId"], "updatedAt": raw["updatedAt"],
+            "value": "#".join(str(raw[k]) for k in SENSORS), "raw": raw, "changed": True}
+
+
+def fmt2(x):
+    # chuẩn hoá cũ (trước DeviceState), giữ lại làm mốc so sánh
+    try: return round(float(x), 2)
+    except: return 0.00
+
+
+def legacy_normalize(src: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+    st = dict(src)
+    for k in SENSORS + PERIOD_KEYS:
+        st[k] = fmt2(st.get(k, 0.0))
+    st["online"] = bool(st.get("online", True))
+    return st, json.dumps(st)
+
+
+class FakeAPI:
+    """Thay APIClient: trả bản ghi dựng sẵn, không gọi mạng."""
+
+    def __init__(self, rows: Dict[str, Dict[str, Any]]) -> None:
+        self.rows = rows
+        self.limiter = RateLimiter(1e9)
+        self.priority = self.limiter.priority
+
+    def read_state_server(self, device_id: str) -> Dict[str, Any]:
+        return self.rows.get(device_id, {})
+
+
+def bench(name: str, fn: Callable[[], Any], ops: int, repeat: int) -> None:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    print(f"{name:<30} {best * 1e3:9.2f} ms  {ops / best:12,.0f} ops/s  ({ops} ops)")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="GTI core benchmarks")
+    ap.add_argument("--devices", type=int, default=200)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+    n, rep = args.devices, args.repeat
+
+    rnd = random.Random(42)
+    rows = {f"GTIControl{i}": _row(i, rnd) for i in range(n)}
+    ids: List[str] = list(rows)
+    raw_rows = [r["raw"] for r in rows.values()]
+
+    coord = Coordinator(None, "homeassistant", {"publish_mqtt": False, "mqtt_device_source": "rest"}, FakeAPI(rows))
+    if fleet_analytics.available():
+        coord.ui.analytics = fleet_analytics.FleetAnalytics()
+
+    # ~5% trường không hợp lệ (chuỗi rác / None) như payload thật thỉnh thoảng gặp
+    decoded = [decode_payload(r) for r in rows.values()]
+    for st in decoded:
+        for k in SENSORS:
+            if rnd.random() < 0.05:
+                st[k] = rnd.choice(["", "n/a", None])
+    layout = Layout(INSTANT_FIELDS + PERIOD_FIELDS)
+    records = [DeviceState(d, layout) for d in ids]
+
+    def record_normalize():
+        now = time.time()
+        for rec, st in zip(records, decoded):
+            rec.update(st, None, now)
+            rec.snapshot(), rec.to_json()
+
+    def cycle():
+        for d in ids:
+            coord.publish_state(d, coord.build_state(d))
+
+    print(f"devices={n} repeat={rep} (best of)")
+    bench("newest_row", lambda: _newest_row(raw_rows), 1, rep)
+    bench("parse_values", lambda: [parse_values(r["value"]) for r in rows.values()], n, rep)
+    bench("decode_payload", lambda: [decode_payload(r) for r in rows.values()], n, rep)
+    bench("normalize+json (fmt2 dict)", lambda: [legacy_normalize(st) for st in decoded], n, rep)
+    bench("normalize+json (DeviceState)", record_normalize, n, rep)
+    bench("build+publish cycle", cycle, n, rep)
+    bench("detector.update", lambda: [coord.detector.update(d, coord.state_cache[d]) for d in ids], n, rep)
+    bench("build_view", lambda: [build_view(coord.state_cache[d]) for d in ids], n, rep)
+    if coord.analytics:
+        bench("fleet summary", coord.analytics.summary, 1, rep)
+    else:
+        print("fleet summary                  skipped (numpy not installed)")
+
+
+if __name__ == "__main__":
+    main()
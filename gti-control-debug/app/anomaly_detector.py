@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Phát hiện derating / bất thường ngay trên luồng state (gọi từ Coordinator.publish_state).
+- Thống kê trượt O(1)/mẫu: EWMA + phương sai EWMA cho mosfet_temp
+- clipping:    power (mẫu tức thời) giữ sát max_power_limit
+- near_cutoff: voltage_dc (mẫu tức thời) sát cutoff_voltage (sắp ngắt)
+- temp_high:   nhiệt độ Mosfet (EWMA) vượt ngưỡng hoặc tăng vọt bất thường
+Ngưỡng mặc định có thể ghi đè theo từng device ở /data/alert_thresholds.json:
+  {"GTIControl283": {"clip_ratio": 0.95, "temp_max": 70}}
+Mỗi cảnh báo có hysteresis: bật/tắt sau `hold` mẫu liên tiếp.
+"""
+
+from __future__ import annotations
+
+import json, math
+from typing import Any, Dict
+
+from device_registry import normalize_did
+
+THRESHOLDS_PATH = "/data/alert_thresholds.json"
+
+DEFAULT_THRESHOLDS = {
+    "alpha": 0.2,           # hệ số EWMA
+    "clip_ratio": 0.97,     # power >= 97% max_power_limit -> clipping
+    "cutoff_margin": 0.03,  # voltage_dc <= cutoff * 1.03 -> near_cutoff
+    "temp_max": 75.0,       # °C
+    "temp_z": 4.0,          # mẫu lệch > 4 sigma so với EWMA -> tăng vọt
+    "hold": 3,              # số mẫu liên tiếp để bật/tắt cảnh báo
+}
+
+# khoảng hợp lệ cho giá trị ghi đè (min, max, kiểu)
+LIMITS = {
+    "alpha": (1e-3, 1.0, float),
+    "clip_ratio": (0.1, 2.0, float),
+    "cutoff_margin": (0.0, 1.0, float),
+    "temp_max": (0.0, 200.0, float),
+    "temp_z": (0.1, 100.0, float),
+    "hold": (1, 1000, int),
+}
+
+ALERTS = {
+    "alert_clipping":    "Cảnh báo cắt công suất (clipping)",
+    "alert_near_cutoff": "Cảnh báo điện áp DC sát ngưỡng ngắt",
+    "alert_temp_high":   "Cảnh báo nhiệt độ Mosfet",
+}
+
+
+class Ewma:
+    __slots__ = ("mean", "var", "n")
+
+    def __init__(self) -> None:
+        self.mean = 0.0
+        self.var = 0.0
+        self.n = 0
+
+    def update(self, x: float, alpha: float) -> None:
+        if self.n == 0:
+            self.mean = x
+        else:
+            diff = x - self.mean
+            incr = alpha * diff
+            self.mean += incr
+            self.var = (1.0 - alpha) * (self.var + diff * incr)
+        self.n += 1
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.var)
+
+
+class _DeviceState:
+    __slots__ = ("temp", "active", "streak")
+
+    def __init__(self) -> None:
+        self.temp = Ewma()
+        self.active = {k: False for k in ALERTS}
+        self.streak = {k: 0 for k in ALERTS}
+
+
+def _f(st: Dict[str, Any], k: str) -> float:
+    try:
+        return float(st.get(k) or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _validated(device_id: str, th: Dict[str, Any]) -> Dict[str, float]:
+    """Ghi đè của 1 device -> ngưỡng đầy đủ; key lạ / giá trị sai kiểu / ngoài khoảng bị bỏ qua."""
+    out: Dict[str, Any] = dict(DEFAULT_THRESHOLDS)
+    for k, v in th.items():
+        lim = LIMITS.get(k)
+        try:
+            if lim is None or isinstance(v, bool):
+                raise ValueError("unknown key" if lim is None else "bool")
+            x = lim[2](float(v))
+            if not lim[0] <= x <= lim[1]:
+                raise ValueError(f"outside [{lim[0]}, {lim[1]}]")
+        except (TypeError, ValueError) as e:
+            print(f"[alerts] {device_id}: ignore {k}={v!r} ({e})")
+            continue
+        out[k] = x
+    return out
+
+
+class AnomalyDetector:
+    def __init__(self, path: str = THRESHOLDS_PATH) -> None:
+        self._devices: Dict[str, _DeviceState] = {}
+        # ngưỡng đã kiểm tra + ép kiểu 1 lần lúc nạp (update() chạy mỗi mẫu)
+        self._overrides: Dict[str, Dict[str, float]] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+        except Exception:
+            raw = None
+        if isinstance(raw, dict):
+            for did, th in raw.items():
+                if isinstance(th, dict):
+                    self._overrides[normalize_did(did)] = _validated(did, th)
+
+    def thresholds(self, device_id: str) -> Dict[str, float]:
+        return self._overrides.get(normalize_did(device_id), DEFAULT_THRESHOLDS)
+
+    def _latch(self, ds: _DeviceState, key: str, cond: bool, hold: int) -> None:
+        # đếm mẫu liên tiếp trái với trạng thái hiện tại, đủ `hold` thì đổi
+        if cond != ds.active[key]:
+            ds.streak[key] += 1
+            if ds.streak[key] >= hold:
+                ds.active[key] = cond
+                ds.streak[key] = 0
+        else:
+            ds.streak[key] = 0
+
+    def update(self, device_id: str, st: Dict[str, Any]) -> Dict[str, bool]:
+        """Cập nhật 1 mẫu, trả các cờ alert_* để gộp vào payload state."""
+        ds = self._devices.get(device_id)
+        if ds is None:
+            ds = self._devices[device_id] = _DeviceState()
+        th = self.thresholds(device_id)
+        alpha, hold = th["alpha"], th["hold"]
+
+        power, vdc, temp = _f(st, "power"), _f(st, "voltage_dc"), _f(st, "mosfet_temp")
+        limit, cutoff = _f(st, "max_power_limit"), _f(st, "cutoff_voltage")
+
+        # spike nhiệt độ so với EWMA trước khi cập nhật
+        spike = ds.temp.n >= hold and ds.temp.std > 0 and (temp - ds.temp.mean) > th["temp_z"] * ds.temp.std
+        ds.temp.update(temp, alpha)
+
+        clipping = limit > 0 and power >= th["clip_ratio"] * limit
+        near_cutoff = cutoff > 0 and 0 < vdc <= cutoff * (1.0 + th["cutoff_margin"])
+        temp_high = ds.temp.mean >= th["temp_max"] or spike
+
+        self._latch(ds, "alert_clipping", clipping, hold)
+        self._latch(ds, "alert_near_cutoff", near_cutoff, hold)
+        self._latch(ds, "alert_temp_high", temp_high, hold)
+        return dict(ds.active)
@@ -1,278 +1,437 @@
-# -*- coding: utf-8 -*-
-"""
-API client cho add-on GTI Control
-- Đọc options ở /data/options.json
-- Đăng nhập Firebase (email/password + firebase_api_key)
-- Lấy danh sách thiết bị thuộc tài khoản
-- Chọn đúng device theo ưu tiên:
-    1) device_suffixes: "283,468"  ->  ["GTIControl283","GTIControl468"]
-    2) include_devices (nếu repo cũ còn dùng)
-    3) thiết bị có userId == UID hoặc thiết bị cập nhật mới nhất
-- Đọc state từ server_base_url
-"""
-
-from __future__ import annotations
-
-import json, os, threading, time
-from typing import Any, Dict, List, Optional
-
+# app/api_client.py
+import os
+import json
+import time
+import threading
 import requests
+from dateutil.parser import isoparse
+from urllib.parse import quote, urlsplit
+from datetime import datetime, timezone
+from typing import Dict, Any, Iterator, Optional, List
 
-# ------------------------------------------------------------
-# Đường dẫn lưu cache nhẹ (token / uid / device đã chọn)
-USER_PATH = "/data/.gti_client.json"
+from rate_limiter import BUDGET_PATH, RateLimiter, RateLimited, parse_retry_after
+from profiler import span
+from device_registry import normalize_did
 
+OPTIONS_PATH = "/data/options.json"
+USER_PATH = "/data/user_options.json"
 
-def _load_options() -> Dict[str, Any]:
-    try:
-        with open("/data/options.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+# endpoint điều khiển / lịch (cùng họ với /api/inverter/data)
+SCHEDULE_PATH = "/api/inverter/schedule"
+CONTROL_PATH = "/api/inverter/control"
+HISTORY_PAGE = 500       # bản ghi / trang khi đọc lịch sử (backfill)
+HISTORY_MAX_PAGES = 200
+
+
+class HistoryIncomplete(Exception):
+    """read_history không đọc hết được khoảng yêu cầu (HTTP lỗi, body hỏng, quá số trang)."""
 
 
-def _now() -> float:
-    return time.time()
+def load_options() -> Dict[str, Any]:
+    with open(OPTIONS_PATH, "r", encoding="utf-8") as f:
+        j = json.load(f)
+    # strip khoảng trắng “vô hình”
+    for k in ("firebase_api_key", "email", "password", "server_base_url"):
+        v = j.get(k)
+        if isinstance(v, str):
+            j[k] = v.strip()
+    return j
+
 
+def _row_ts(row: Dict[str, Any]) -> str:
+    return row.get("updatedAt") or row.get("createdAt") or ""
 
-def _parse_float(x: str) -> Optional[float]:
+
+def _epoch(ts: str) -> Optional[float]:
+    """ISO 8601 -> epoch giây (không có múi giờ thì coi là UTC); None nếu không đọc được."""
     try:
-        return float(x)
-    except Exception:
+        dt = isoparse(ts)
+    except (ValueError, OverflowError):
         return None
+    return (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
 
 
-class APIClient:
-    def __init__(self, opt: Optional[Dict[str, Any]] = None) -> None:
-        self.opt: Dict[str, Any] = opt or _load_options()
-        self.email: str = self.opt.get("email", "") or ""
-        self.password: str = self.opt.get("password", "") or ""
-        self.firebase_api_key: str = self.opt.get("firebase_api_key", "") or ""
-        self.server_base_url: str = (self.opt.get("server_base_url") or "https://giabao-inverter.com").rstrip("/")
-        self.session = requests.Session()
-        self.session.headers.update({"User-Agent": "GTIControl/HA"})
-
-        # token & user
-        self.id_token: Optional[str] = None
-        self.uid: Optional[str] = None
-        self.exp_at: float = 0.0
+def row_epoch(row: Dict[str, Any]) -> Optional[float]:
+    """updatedAt/createdAt (ISO 8601) -> epoch giây; None nếu không đọc được."""
+    return _epoch(_row_ts(row))
 
-        # devices
-        self.device_ids: List[str] = []
-        self.device_id: Optional[str] = None  # thiết bị đang bound
 
-        self._lock = threading.Lock()
-        self._load_user_cache()
+def _newer(ts: Optional[float], wm: Optional[float]) -> bool:
+    """So theo epoch: chuỗi ISO khác múi giờ / khác số chữ số thập phân không so lexical được."""
+    return ts is not None and (wm is None or ts > wm)
 
-    # ---------------- persistence ----------------
-    def _load_user_cache(self) -> None:
-        try:
-            with open(USER_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            self.id_token = data.get("id_token") or None
-            self.uid = data.get("uid") or None
-            self.exp_at = float(data.get("exp_at") or 0)
-            self.device_id = data.get("device_id") or None
-        except Exception:
-            pass
-
-    def _save_user_cache(self) -> None:
-        data = {
-            "id_token": self.id_token,
-            "uid": self.uid,
-            "exp_at": self.exp_at,
-            "device_id": self.device_id,
+
+def parse_values(value: Any) -> List[float]:
+    """'12.5#230#...' -> [12.5, 230.0, ...] (bỏ phần rỗng / không phải số)."""
+    out: List[float] = []
+    if isinstance(value, str):
+        for p in value.split("#"):
+            try:
+                out.append(float(p))
+            except ValueError:
+                continue
+    return out
+
+
+def _rows_of(j: Any) -> List[Dict[str, Any]]:
+    """
+    Body /api/inverter/data -> list bản ghi. Server có nhiều kiểu trả:
+    {"data": [{...}, ...]}, {"data": {...}}, {"raw": {...}, "values": [...]} hoặc list trần.
+    """
+    if isinstance(j, dict):
+        node = j.get("data")
+        if node is None and isinstance(j.get("raw"), dict):
+            node = j["raw"]
+        j = [node] if isinstance(node, dict) else node
+    return [r for r in j if isinstance(r, dict)] if isinstance(j, list) else []
+
+
+def _newest_row(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Chọn bản ghi mới nhất (theo epoch) trong 1 lượt duyệt (không sort cả list)."""
+    best = rows[0]
+    best_ts = row_epoch(best)
+    for r in rows:
+        ts = row_epoch(r)
+        if _newer(ts, best_ts):
+            best, best_ts = r, ts
+    return best
+
+
+class APIClient:
+    """Client lo phần login + gọi REST tới server giabao-inverter."""
+
+    def __init__(self, opts: Dict[str, Any]):
+        self.base = (opts.get("server_base_url") or "").rstrip("/")
+        self.email = opts.get("email") or ""
+        self.password = opts.get("password") or ""
+        self.api_key = opts.get("firebase_api_key") or ""
+        self.server_enabled = bool(opts.get("server_enabled", True))
+        self.s = requests.Session()
+        # ngân sách request chung cho poller, UI và lệnh điều khiển (mọi process, qua BUDGET_PATH)
+        self.limiter = RateLimiter(float(opts.get("api_rate_per_minute", 60)), path=BUDGET_PATH)
+        self.priority = self.limiter.priority
+
+        self._lock = threading.Lock()
+        self.id_token: Optional[str] = None
+        self.uid: Optional[str] = None
+        self.exp_at: int = 0  # epoch seconds
+
+        # watermark updatedAt theo device -> bỏ qua decode/publish khi không có bản ghi mới
+        self._watermarks: Dict[str, str] = {}
+        self._last_state: Dict[str, Dict[str, Any]] = {}
+        # theo device: server có hiểu ?since= không (None = chưa biết); lần đọc gần nhất có bản ghi
+        # đến từ fallback ?uid= không (id dạng khác server) -> không được bỏ qua fallback
+        self._since_ok: Dict[str, Optional[bool]] = {}
+        self._via_uid: Dict[str, bool] = {}
+
+        # nạp cache nếu có
+        if os.path.exists(USER_PATH):
+            try:
+                c = json.load(open(USER_PATH, "r", encoding="utf-8"))
+                self.id_token = c.get("idToken")
+                self.uid = c.get("localId")
+                self.exp_at = int(c.get("expires_at") or 0)
+            except Exception:
+                pass
+
+    def reload(self, opts: Dict[str, Any]) -> bool:
+        """
+        Login lại từ UI: đổi thông tin đăng nhập tại chỗ (coordinator, source, registry, backfill
+        giữ đúng object này và limiter của nó). Trả True nếu tài khoản / server đổi.
+        """
+        creds = ((opts.get("server_base_url") or "").rstrip("/"), opts.get("email") or "",
+                 opts.get("password") or "", opts.get("firebase_api_key") or "")
+        with self._lock:
+            changed = creds != (self.base, self.email, self.password, self.api_key)
+            self.base, self.email, self.password, self.api_key = creds
+            self.server_enabled = bool(opts.get("server_enabled", True))
+            if changed:
+                # token / watermark của tài khoản cũ không còn dùng được
+                self.id_token, self.uid, self.exp_at = None, None, 0
+                self._watermarks.clear()
+                self._last_state.clear()
+                self._since_ok.clear()
+                self._via_uid.clear()
+        return changed
+
+    # ---------- nội bộ ----------
+    def _save_cache(self, id_token: str, uid: str, expires_in: int) -> None:
+        self.id_token = id_token
+        self.uid = uid
+        self.exp_at = int(time.time()) + int(expires_in or 3600)
+        save = {
+            "idToken": self.id_token,
+            "localId": self.uid,
+            "expires_at": self.exp_at,
+            "server_base_url": self.base,
         }
         os.makedirs(os.path.dirname(USER_PATH), exist_ok=True)
         with open(USER_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+            json.dump(save, f, ensure_ascii=False, indent=2)
+
+    def _request(self, method: str, url: str, **kw) -> requests.Response:
+        """Mọi request tới server đi qua token bucket; 429/503 -> tôn trọng Retry-After."""
+        prio = self.limiter.current
+        with span("rate_wait", prio=prio):
+            ok = self.limiter.acquire(prio)
+        if not ok:
+            raise RateLimited(f"request budget exhausted (priority {prio})")
+        with span("http", method=method, path=urlsplit(url).path):
+            r = self.s.request(method, url, **kw)
+        if r.status_code in (429, 503):
+            wait = parse_retry_after(r.headers.get("Retry-After"))
+            self.limiter.penalize(wait)
+            print("[api] server rate limit, retry after", round(wait, 1), "s")
+        return r
 
-    # ---------------- auth ----------------
     def _token_valid(self) -> bool:
-        return bool(self.id_token) and (_now() < (self.exp_at - 60))
+        # còn >60s coi như hợp lệ
+        return bool(self.id_token) and (time.time() < (self.exp_at - 60))
 
+    # ---------- public ----------
     def login(self, force: bool = False) -> bool:
-        if not force and self._token_valid():
+        """Login Firebase. Trả True nếu OK (hoặc đã có token hợp lệ)."""
+        if not self.server_enabled:
+            print("[api] server disabled")
             return True
 
-        if not (self.email and self.password and self.firebase_api_key):
-            print("[api] missing email/password/firebase_api_key")
-            return False
-
-        url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={self.firebase_api_key}"
-        payload = {"email": self.email, "password": self.password, "returnSecureToken": True}
-
-        r = self.session.post(url, json=payload, timeout=30)
-        if r.status_code != 200:
+        with self._lock:
+            if (not force) and self._token_valid():
+                print("[api] already have valid token")
+                return True
+
+            if not (self.api_key and self.email and self.password):
+                print("[api] missing api_key/email/password in options.json")
+                return False
+
+            url = "https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword"
+            params = {"key": self.api_key}
+            payload = {
+                "email": self.email,
+                "password": self.password,
+                "returnSecureToken": True,
+            }
             try:
-                err = r.json()
-            except Exception:
-                err = {"message": r.text}
-            print("[api] firebase FAIL:", err)
-            return False
-
-        data = r.json()
-        self.id_token = data.get("idToken")
-        self.uid = data.get("localId") or data.get("localID") or data.get("uid")
-        valid_for = int(data.get("expiresIn", "3600"))
-        self.exp_at = _now() + valid_for
-        self._save_user_cache()
-        print(f"[api] login ok uid= {self.uid} valid_for= {valid_for}s")
-        return True
-
-    # ---------------- device helpers ----------------
-    @staticmethod
-    def _normalize_did(x: str) -> str:
-        """Chấp nhận 'gti283'/'GTIControl283' -> 'GTIControl283'"""
-        if not x:
-            return x
-        xs = x.strip()
-        if xs.lower().startswith("gti"):
-            # 'gti283' or 'gticontrol283'
-            num = "".join(ch for ch in xs if ch.isdigit())
-            if num:
-                return f"GTIControl{num}"
-        return xs
-
-    def _want_devices_from_options(self) -> List[str]:
-        want: List[str] = []
-
-        # device_suffixes: "283,468"
-        suffixes = (self.opt.get("device_suffixes") or "").strip()
-        if suffixes:
-            for s in [p.strip() for p in suffixes.replace(";", ",").split(",") if p.strip()]:
-                want.append(f"GTIControl{s}")
-
-        # include_devices: ["GTIControl283", "gti468", ...]
-        inc = self.opt.get("include_devices") or []
-        if isinstance(inc, list):
-            for x in inc:
-                if isinstance(x, str) and x.strip().lower() != "all":
-                    want.append(self._normalize_did(x))
-        # loại trùng
-        seen = set()
-        out: List[str] = []
-        for d in want:
-            if d not in seen:
-                out.append(d)
-                seen.add(d)
-        return out
+                print(f"[api] POST {url}?key={self.api_key[:6]}…{self.api_key[-4:]}")
+                with span("login"):
+                    r = self.s.post(url, params=params, json=payload, timeout=20)
+                print("[api] ->", r.status_code)
+                if not r.ok:
+                    # không log token hay thông tin nhạy cảm
+                    print("[api] firebase FAIL (masked)", (r.text or "")[:180])
+                    return False
+                j = r.json()
+                idt = j.get("idToken")
+                uid = j.get("localId")
+                exp = int(j.get("expiresIn") or 3600)
+                if not (idt and uid):
+                    print("[api] login response missing token/uid")
+                    return False
+                self._save_cache(idt, uid, exp)
+                print("[api] login ok uid=", uid, "valid_for=", exp, "s")
+                return True
+            except Exception as e:
+                print("[api] login exception:", e)
+                return False
 
     def list_devices(self) -> List[Dict[str, Any]]:
-        """Trả về list các dict thô server trả về (ít nhất có deviceId, userId, updatedAt, raw/value...)"""
+        """Danh sách bản ghi thiết bị của user (deviceId, userId, updatedAt...)."""
         if not self.login():
             return []
-
-        url = f"{self.server_base_url}/api/inverter/data"
-        params = {"uid": self.uid, "deviceId": "all"}
-
-        r = self.session.get(url, params=params, timeout=30)
-        if r.status_code != 200:
-            print("[api] GET devices FAIL", r.status_code, r.text[:200])
+        url = f"{self.base}/api/inverter/data?uid={self.uid}&deviceId=all"
+        h = {
+            "Authorization": f"Bearer {self.id_token}",
+            "Accept": "application/json",
+        }
+        try:
+            r = self._request("GET", url, headers=h, timeout=30)
+            print("[api] GET", url)
+            print("[api] ->", r.status_code)
+            if not r.ok:
+                return []
+            j = r.json()
+        except RateLimited:
+            raise
+        except Exception as e:
+            print("[api] list_devices exception:", e)
             return []
-
-        data = r.json()
-        items: List[Dict[str, Any]] = []
         # API có 2 kiểu: {data:[{...},...]} hoặc trả thẳng list
-        if isinstance(data, dict) and isinstance(data.get("data"), list):
-            items = data["data"]
-        elif isinstance(data, list):
-            items = data
-        # lưu danh sách id
-        self.device_ids = []
-        for d in items:
-            did = d.get("deviceId") or d.get("device_id")
-            if isinstance(did, str):
-                self.device_ids.append(did)
-        return items
-
-    def _choose_device(self) -> Optional[str]:
-        items = self.list_devices()
-        if not items:
-            return None
-
-        # ưu tiên theo options
-        want = self._want_devices_from_options()
-        if want:
-            for w in want:
-                for d in items:
-                    if (d.get("deviceId") or "").strip() == w:
-                        return w
-
-        # ưu tiên userId == uid
-        for d in items:
-            if d.get("userId") == self.uid and isinstance(d.get("deviceId"), str):
-                return d["deviceId"]
-
-        # fallback: updatedAt mới nhất
-        def _ts(d: Dict[str, Any]) -> str:
-            return str(d.get("updatedAt") or "")
-
-        items_sorted = sorted(items, key=_ts, reverse=True)
-        did = items_sorted[0].get("deviceId")
-        return did if isinstance(did, str) else None
-
-    def ensure_device(self) -> Optional[str]:
-        """Đảm bảo self.device_id đã có; nếu chưa thì chọn theo tiêu chí trên."""
-        if self.device_id and self.device_id in self.device_ids:
-            return self.device_id
-        with self._lock:
-            if not self.login():
-                return None
-            # nếu cache có mà không nằm trong list hiện tại, vẫn thử dùng
-            if self.device_id and self.device_id not in self.device_ids:
-                return self.device_id
-            picked = self._choose_device()
-            if picked:
-                self.device_id = picked
-                self._save_user_cache()
-            return self.device_id
-
-    # ---------------- read state ----------------
-    def read_state_server(self, device_id: Optional[str] = None) -> Dict[str, Any]:
-        """Đọc state thô + parse values từ server."""
-        if not self.login():
-            return {}
-
-        did = device_id or self.device_id or self.ensure_device()
-        if not did:
+        if isinstance(j, dict) and isinstance(j.get("data"), list):
+            return j["data"]
+        return j if isinstance(j, list) else []
+
+    def read_state_server(self, device_hint: str, peek: bool = False) -> Dict[str, Any]:
+        """
+        Lấy bản ghi mới nhất cho user từ server.
+        Ưu tiên: /api/inverter/data?uid=<uid>&deviceId=<device_hint>
+        Fallback: /api/inverter/data?uid=<uid>
+        Nếu đã có watermark updatedAt cho device thì gửi kèm &since=<watermark>;
+        server không hiểu tham số này thì tự tắt và chỉ lọc phía client.
+        Trả về dict rỗng nếu không có dữ liệu; "changed": False nếu bản ghi mới nhất
+        trùng với lần đọc trước.
+        Watermark / "changed" là của poller (Coordinator). UI / debug gọi với peek=True:
+        luôn đọc bản ghi mới nhất, không dùng và không đổi watermark (không "ăn" mẫu của poller).
+        """
+        # server_enabled: false -> login() trả True nhưng không có uid/token: không gọi upstream
+        if not self.server_enabled or not self.login():
             return {}
 
-        did = self._normalize_did(did)
-        url = f"{self.server_base_url}/api/inverter/data"
-        params = {"uid": self.uid, "deviceId": did}
+        def _get(url: str) -> Optional[Dict[str, Any]]:
+            h = {
+                "Authorization": f"Bearer {self.id_token}",
+                "Accept": "application/json",
+            }
+            r = self._request("GET", url, headers=h, timeout=15)
+            print("[api] GET", url)
+            print("[api] ->", r.status_code)
+            if not r.ok:
+                return None
+            try:
+                return r.json()
+            except Exception:
+                return None
 
-        r = self.session.get(url, params=params, timeout=30)
-        if r.status_code != 200:
-            print("[api] GET state FAIL", r.status_code, r.text[:200])
+        # watermark giữ nguyên chuỗi server trả (gửi lại qua ?since=), so sánh thì theo epoch
+        wm = "" if peek else self._watermarks.get(device_hint, "")
+        wm_ts = _epoch(wm) if wm else None
+        since_ok = self._since_ok.get(device_hint)
+        since = f"&since={quote(wm)}" if (wm and since_ok is not False) else ""
+
+        base = self.base.rstrip("/")
+        # 1) theo device_hint (gti283 / 283)
+        url1 = f"{base}/api/inverter/data?uid={self.uid}&deviceId={device_hint}{since}"
+        j = _get(url1)
+        rows = _rows_of(j)
+
+        # 2) fallback theo uid: chỉ bỏ qua khi device này đọc được qua deviceId= và server
+        #    đã xác nhận (?since=) là không có bản ghi mới hơn
+        via_uid = False
+        if not rows and not (since and since_ok and not self._via_uid.get(device_hint)):
+            url2 = f"{base}/api/inverter/data?uid={self.uid}{since}"
+            j2 = _get(url2)
+            # ?uid= trả bản ghi của mọi device trong tài khoản: chỉ giữ đúng device này
+            # (không thì device lạ/cũ nhận dữ liệu của inverter khác)
+            want = normalize_did(device_hint)
+            rows = [r for r in _rows_of(j2) if normalize_did(str(r.get("deviceId") or "")) == want]
+            via_uid = bool(rows)
+
+        if rows and not peek:
+            self._via_uid[device_hint] = via_uid
+            if since:
+                # server bỏ qua ?since= nếu vẫn trả về bản ghi cũ
+                self._since_ok[device_hint] = all(_newer(row_epoch(r), wm_ts) for r in rows)
+
+        if not rows:
+            if wm and device_hint in self._last_state:
+                return dict(self._last_state[device_hint], changed=False)
             return {}
 
-        data = r.json() if r.headers.get("content-type", "").startswith("application/json") else {}
-        # server có kiểu trả: {"raw":{...}, "values":[...]} hoặc {"data":{...}}
-        node = data.get("raw") or data.get("data") or data
-        values_str = ""
-        if isinstance(node, dict):
-            values_str = node.get("value") or node.get("Value") or ""
-
-        values: List[float] = []
-        if isinstance(values_str, str) and values_str:
-            parts = [p for p in values_str.split("#") if p != ""]
-            for p in parts:
-                v = _parse_float(p)
-                if v is not None:
-                    values.append(v)
+        row = _newest_row(rows)
+        if wm and not _newer(row_epoch(row), wm_ts) and device_hint in self._last_state:
+            return dict(self._last_state[device_hint], changed=False)
+
+        val = (row.get("value") or "").strip()
 
         out = {
-            "raw": node,
-            "values": values,
-            "ts": int(_now() * 1_000_000),  # microseconds
+            "deviceId": row.get("deviceId"),
+            "userId": row.get("userId"),
+            "createdAt": row.get("createdAt"),
+            "updatedAt": row.get("updatedAt"),
+            "value": val,
+            "values": parse_values(val),
+            "raw": row,
         }
-        # lưu device nếu thành công
-        self.device_id = did
-        self._save_user_cache()
-        return out
+        if not peek:
+            self._watermarks[device_hint] = _row_ts(row)
+            self._last_state[device_hint] = out
+        return dict(out, changed=True)
+
+    def read_history(self, device_id: str, t_from: float, t_to: float,
+                     page_size: int = HISTORY_PAGE) -> Iterator[Dict[str, Any]]:
+        """
+        Bản ghi trong [t_from, t_to) theo trang (&from=&to=&page=&limit=), từng trang một.
+        Server bỏ qua phân trang (trang sau trùng trang trước / ngắn hơn limit) thì dừng;
+        bỏ qua from/to thì lọc lại phía client.
+        Trang lỗi (kể cả 429 vừa penalize) / body hỏng / vượt HISTORY_MAX_PAGES -> HistoryIncomplete
+        (RateLimited nếu hết ngân sách): caller không được coi khoảng này là đã đọc xong.
+        """
+        if not self.login():
+            raise HistoryIncomplete(f"{device_id}: login failed")
+        frm = datetime.fromtimestamp(t_from, tz=timezone.utc).isoformat()
+        to = datetime.fromtimestamp(t_to, tz=timezone.utc).isoformat()
+        first_prev = None
+        for page in range(1, HISTORY_MAX_PAGES + 1):
+            url = (f"{self.base}/api/inverter/data?uid={self.uid}&deviceId={device_id}"
+                   f"&from={quote(frm)}&to={quote(to)}&page={page}&limit={page_size}")
+            r = self._request("GET", url, headers=self._auth_headers(), timeout=30)
+            print("[api] GET history", device_id, "page", page, "->", r.status_code)
+            if not r.ok:
+                raise HistoryIncomplete(f"{device_id} page {page}: HTTP {r.status_code}")
+            try:
+                j = r.json()
+            except ValueError:
+                raise HistoryIncomplete(f"{device_id} page {page}: invalid JSON")
+            rows = _rows_of(j)
+            if not rows or rows[0] == first_prev:
+                return
+            first_prev = rows[0]
+            for row in rows:
+                ts = row_epoch(row)
+                if ts is not None and t_from <= ts < t_to:
+                    yield row
+            if len(rows) < page_size:
+                return
+        raise HistoryIncomplete(f"{device_id}: more than {HISTORY_MAX_PAGES} pages")
+
+    def _auth_headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.id_token}", "Accept": "application/json"}
+
+    def get_schedules(self, device_id: str) -> Dict[str, Any]:
+        """{"schedule1": {"start","end","cutoff_voltage","max_power"}, ...}; {} nếu lỗi."""
+        if not self.login():
+            return {}
+        url = f"{self.base}{SCHEDULE_PATH}?uid={self.uid}&deviceId={device_id}"
+        try:
+            r = self._request("GET", url, headers=self._auth_headers(), timeout=15)
+            print("[api] GET", url)
+            print("[api] ->", r.status_code)
+            if not r.ok:
+                return {}
+            j = r.json()
+        except RateLimited:
+            raise
+        except Exception as e:
+            print("[api] get_schedules exception:", e)
+            return {}
+        if isinstance(j, dict) and isinstance(j.get("data"), dict):
+            j = j["data"]
+        return j if isinstance(j, dict) else {}
 
+    def _control(self, device_id: str, payload: Dict[str, Any]) -> bool:
+        if not self.login():
+            return False
+        url = f"{self.base}{CONTROL_PATH}"
+        body = {"uid": self.uid, "deviceId": device_id, **payload}
+        try:
+            r = self._request("POST", url, headers=self._auth_headers(), json=body, timeout=15)
+            print("[api] POST", url, sorted(payload))
+            print("[api] ->", r.status_code)
+            return r.ok
+        except RateLimited:
+            raise
+        except Exception as e:
+            print("[api] control exception:", e)
+            return False
 
-# tiện lợi cho server import
-def load_options() -> Dict[str, Any]:
-    return _load_options()
+    def set_cutoff_voltage(self, device_id: str, value: float) -> bool:
+        return self._control(device_id, {"cutoff_voltage": value})
+
+    def set_max_power(self, device_id: str, value: float) -> bool:
+        return self._control(device_id, {"max_power_limit": value})
+
+    def set_schedule(self, device_id: str, idx: int, start: str, end: str,
+                     cutoff_voltage: float, max_power: float) -> bool:
+        return self._control(device_id, {"schedule": {
+            "index": idx, "start": start, "end": end,
+            "cutoff_voltage": cutoff_voltage, "max_power": max_power,
+        }})
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Bù long-term statistics của HA cho các khoảng add-on/upstream bị gián đoạn.
+1) Tìm khoảng trống trong các mẫu đã publish (HistoryStore, /data/history) dài hơn backfill_gap_minutes
+2) Đọc lịch sử thiếu từ /api/inverter/data theo trang (APIClient.read_history), mở rộng ra trọn giờ
+3) Tính tổng hợp theo giờ tại chỗ:
+   - energy_total / grid_energy_total / tieuthu_energy_total: state cuối giờ + sum luỹ kế
+   - power / grid_power / tieuthu_power: mean / min / max
+4) Gửi 1 lần qua websocket HA (recorder/import_statistics) cho mỗi statistic:
+   vào thẳng statistics của entity MQTT (lấp lỗ trên Energy dashboard),
+   không tìm thấy entity thì dùng external statistic "gti:<device>_<key>".
+Cần homeassistant_api: true (SUPERVISOR_TOKEN) và gói websocket-client.
+"""
+
+from __future__ import annotations
+
+import json, os, threading, time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import requests
+
+from api_client import HistoryIncomplete, row_epoch
+from history_store import HistoryStore
+from mapping import GTI_SENSORS, GRID_SENSORS, TIEUTHU_SENSORS
+from rate_limiter import RateLimited
+from sources import decode_payload
+from state_record import to_float
+
+try:
+    import websocket  # websocket-client
+except ImportError:
+    websocket = None
+
+STATE_PATH = "/data/backfill-{shard}.json"  # mỗi shard 1 file (ghi đè toàn bộ khi lưu)
+LEGACY_STATE_PATH = "/data/backfill.json"
+HA_WS_URL = "ws://supervisor/core/websocket"
+HOUR = 3600
+
+SUM_KEYS = ("energy_total", "grid_energy_total", "tieuthu_energy_total")
+MEAN_KEYS = ("power", "grid_power", "tieuthu_power")
+META = {**GTI_SENSORS, **GRID_SENSORS, **TIEUTHU_SENSORS}
+
+Gap = Tuple[float, float]
+
+
+def available() -> bool:
+    return websocket is not None and bool(os.getenv("SUPERVISOR_TOKEN"))
+
+
+def _hour(ts: float) -> float:
+    return ts - ts % HOUR
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+
+
+# ---------------- 1) khoảng trống ----------------
+def find_gaps(store: HistoryStore, device_id: str, t_from: float, t_to: float, min_gap: float) -> List[Gap]:
+    """Khoảng (a, b) giữa 2 mẫu liên tiếp cách nhau > min_gap, đã mở rộng ra trọn giờ."""
+    gaps: List[Gap] = []
+    prev: Optional[float] = None
+    for row in store.iter_rows(device_id, t_from, t_to):
+        ts = row.get("ts", 0)
+        if prev is not None and ts - prev > min_gap:
+            a, b = _hour(prev), _hour(ts) + HOUR
+            if gaps and a <= gaps[-1][1]:
+                gaps[-1] = (gaps[-1][0], max(gaps[-1][1], b))
+            else:
+                gaps.append((a, b))
+        prev = max(prev or ts, ts)
+    return gaps
+
+
+# ---------------- 3) tổng hợp theo giờ ----------------
+class HourlyAggregator:
+    """Gom mẫu (ts, dict) theo giờ, O(1) bộ nhớ mỗi giờ/key; mẫu có thể đến không theo thứ tự."""
+
+    def __init__(self) -> None:
+        # key -> hour -> [n, total, min, max, last_ts, last]
+        self.buckets: Dict[str, Dict[float, List[float]]] = defaultdict(dict)
+
+    def add(self, ts: float, st: Dict[str, Any]) -> None:
+        h = _hour(ts)
+        for k in SUM_KEYS + MEAN_KEYS:
+            v = to_float(st.get(k))
+            if v is None:
+                continue
+            b = self.buckets[k].get(h)
+            if b is None:
+                self.buckets[k][h] = [1, v, v, v, ts, v]
+                continue
+            b[0] += 1
+            b[1] += v
+            b[2] = min(b[2], v)
+            b[3] = max(b[3], v)
+            if ts >= b[4]:
+                b[4], b[5] = ts, v
+
+    def mean_rows(self, key: str) -> List[Dict[str, Any]]:
+        return [{"start": _iso(h), "mean": round(b[1] / b[0], 3), "min": b[2], "max": b[3]}
+                for h, b in sorted(self.buckets.get(key, {}).items())]
+
+    def sum_rows(self, key: str, base_state: Optional[float], base_sum: float) -> List[Dict[str, Any]]:
+        """
+        state = giá trị cuối giờ; sum nối tiếp từ thống kê ngay trước khoảng trống
+        (base_state/base_sum). Bộ đếm reset (giá trị giảm) -> tính lại từ 0 như HA.
+        """
+        rows = []
+        last, total = base_state, base_sum
+        for h, b in sorted(self.buckets.get(key, {}).items()):
+            state = b[5]
+            if last is not None:
+                total += state - last if state >= last else state
+            last = state
+            rows.append({"start": _iso(h), "state": state, "sum": round(total, 3)})
+        return rows
+
+
+# ---------------- 4) websocket HA ----------------
+class HaStatistics:
+    def __init__(self, url: str = HA_WS_URL, token: Optional[str] = None) -> None:
+        self.url = url
+        self.token = token or os.getenv("SUPERVISOR_TOKEN", "")
+        self.ws = None
+        self._id = 0
+
+    def __enter__(self) -> "HaStatistics":
+        self.ws = websocket.create_connection(self.url, timeout=30)
+        json.loads(self.ws.recv())  # auth_required
+        self.ws.send(json.dumps({"type": "auth", "access_token": self.token}))
+        msg = json.loads(self.ws.recv())
+        if msg.get("type") != "auth_ok":
+            raise RuntimeError(f"HA websocket auth failed: {msg.get('message')}")
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.ws is not None:
+            self.ws.close()
+
+    def call(self, type_: str, **kw) -> Any:
+        self._id += 1
+        self.ws.send(json.dumps({"id": self._id, "type": type_, **kw}))
+        while True:
+            msg = json.loads(self.ws.recv())
+            if msg.get("id") == self._id and msg.get("type") == "result":
+                if not msg.get("success"):
+                    raise RuntimeError(f"{type_}: {msg.get('error')}")
+                return msg.get("result")
+
+    def entity_ids(self) -> Dict[str, str]:
+        """unique_id (<device>_<key>, xem mqtt_discovery.obj_id) -> entity_id của các sensor MQTT."""
+        out = {}
+        for e in self.call("config/entity_registry/list") or []:
+            if e.get("platform") == "mqtt" and e.get("unique_id"):
+                out[e["unique_id"]] = e["entity_id"]
+        return out
+
+    def last_before(self, statistic_id: str, ts: float) -> Tuple[Optional[float], float]:
+        """(state, sum) của giờ thống kê cuối cùng trước ts (tìm lùi tối đa 7 ngày)."""
+        res = self.call("recorder/statistics_during_period", start_time=_iso(ts - 7 * 86400),
+                        end_time=_iso(ts), statistic_ids=[statistic_id], period="hour",
+                        types=["state", "sum"]) or {}
+        rows = res.get(statistic_id) or []
+        if not rows:
+            return None, 0.0
+        return rows[-1].get("state"), float(rows[-1].get("sum") or 0.0)
+
+    def import_statistics(self, metadata: Dict[str, Any], stats: List[Dict[str, Any]]) -> None:
+        self.call("recorder/import_statistics", metadata=metadata, stats=stats)
+
+
+# ---------------- điều phối ----------------
+class Backfill:
+    def __init__(self, api_client, history: HistoryStore, options: Dict[str, Any],
+                 path: str = STATE_PATH, shard: int = 0) -> None:
+        self.api = api_client
+        self.history = history
+        self.path = path.format(shard=shard)
+        self.min_gap = 60.0 * float(options.get("backfill_gap_minutes", 15))
+        self.days = int(options.get("backfill_days", 7))
+        self.interval = int(options.get("backfill_interval", 3600))
+        self.done: Dict[str, List[Gap]] = self._load()
+        self.last_run: Dict[str, Any] = {}
+
+    def _load(self) -> Dict[str, List[Gap]]:
+        # chưa có file của shard: đọc file chung cũ (khoảng của device shard khác không bao giờ khớp)
+        for p in (self.path, LEGACY_STATE_PATH):
+            try:
+                with open(p, "r", encoding="utf-8") as f:
+                    return {d: [tuple(g) for g in gs] for d, gs in (json.load(f) or {}).items()}
+            except Exception:
+                continue
+        return {}
+
+    def _save(self) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.done, f)
+        os.replace(tmp, self.path)
+
+    def pending_gaps(self, device_id: str, now: float) -> List[Gap]:
+        # chỉ giờ đã đóng: giờ hiện tại do recorder HA tự tổng hợp
+        t_from, t_to = now - self.days * 86400, _hour(now)
+        done = set(self.done.get(device_id, []))
+        return [g for g in find_gaps(self.history, device_id, t_from, t_to, self.min_gap)
+                if g not in done and g[1] <= t_to]
+
+    def collect(self, device_id: str, gaps: Iterable[Gap]) -> Tuple[HourlyAggregator, List[Gap]]:
+        """Chỉ khoảng đọc đủ mọi trang mới vào fetched (và aggregator); lỗi giữa chừng -> lần chạy sau."""
+        agg, fetched = HourlyAggregator(), []
+        for a, b in gaps:
+            try:
+                samples = [(ts, decode_payload(row)) for row in self.api.read_history(device_id, a, b)
+                           for ts in (row_epoch(row),) if ts is not None]
+            except RateLimited:
+                break  # hết ngân sách: phần còn lại để lần chạy sau
+            except (HistoryIncomplete, requests.RequestException) as e:
+                print("[backfill]", device_id, "gap", _iso(a), "-", _iso(b), "not read:", e)
+                break
+            for ts, st in samples:
+                agg.add(ts, st)
+            fetched.append((a, b))
+        return agg, fetched
+
+    def run_once(self, device_ids: List[str]) -> Dict[str, Any]:
+        now = time.time()
+        work = {}
+        for d in device_ids:
+            gaps = self.pending_gaps(d, now)
+            if gaps:
+                agg, fetched = self.collect(d, gaps)
+                if fetched:
+                    work[d] = (agg, fetched)
+        summary = {"ts": now, "devices": len(work), "gaps": sum(len(f) for _, f in work.values()), "statistics": 0}
+        if not work:
+            self.last_run = summary
+            return summary
+
+        with HaStatistics() as ha:
+            entities = ha.entity_ids()
+            for d, (agg, fetched) in work.items():
+                start = min(a for a, _ in fetched)
+                for key in SUM_KEYS + MEAN_KEYS:
+                    if not agg.buckets.get(key):
+                        continue
+                    uid = f"{d}_{key}"
+                    sid = entities.get(uid)
+                    meta = {"has_mean": key in MEAN_KEYS, "has_sum": key in SUM_KEYS,
+                            "name": None if sid else f"{d} {META[key][0]}",
+                            "source": "recorder" if sid else "gti",
+                            "statistic_id": sid or f"gti:{uid.lower()}",
+                            "unit_of_measurement": META[key][1]}
+                    if key in SUM_KEYS:
+                        base_state, base_sum = ha.last_before(meta["statistic_id"], start)
+                        stats = agg.sum_rows(key, base_state, base_sum)
+                    else:
+                        stats = agg.mean_rows(key)
+                    ha.import_statistics(meta, stats)
+                    summary["statistics"] += 1
+                self.done.setdefault(d, []).extend(fetched)
+
+        # bỏ khoảng đã ra khỏi cửa sổ backfill_days
+        cutoff = now - self.days * 86400
+        self.done = {d: [g for g in gs if g[1] > cutoff] for d, gs in self.done.items()}
+        self._save()
+        self.last_run = summary
+        print("[backfill]", summary)
+        return summary
+
+    def start(self, devices) -> None:
+        """devices: callable trả danh sách device (của shard này) mỗi lần chạy."""
+        def _run():
+            time.sleep(60)  # để coordinator ghi vài mẫu trước
+            while True:
+                try:
+                    self.run_once(devices())
+                except Exception as e:
+                    print("[backfill] error:", e)
+                time.sleep(self.interval)
+        threading.Thread(target=_run, name="backfill", daemon=True).start()
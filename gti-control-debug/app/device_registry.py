@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Registry thiết bị lưu ở /data/devices.json
+- Index theo ID chuẩn hoá: 'gti283' / 'GTIControl283' / '283' -> 'GTIControl283'
+- Metadata: deviceId thật trên server, owner uid, last_seen (updatedAt), firmware
+- Đối soát định kỳ với server trong thread nền; coordinator/UI chỉ tra cứu local
+"""
+
+from __future__ import annotations
+
+import json, os, threading, time, zlib
+from typing import Any, Dict, List, Optional
+
+REGISTRY_PATH = "/data/devices.json"
+
+
+def normalize_did(x: str) -> str:
+    """Chấp nhận 'gti283'/'GTIControl283'/'283' -> 'GTIControl283'"""
+    if not x:
+        return x
+    xs = x.strip()
+    if xs.isdigit():
+        return f"GTIControl{xs}"
+    if xs.lower().startswith("gti"):
+        num = "".join(ch for ch in xs if ch.isdigit())
+        if num:
+            return f"GTIControl{num}"
+    return xs
+
+
+def shard_of(device_id: str, shards: int) -> int:
+    """Shard ổn định theo ID chuẩn hoá (không phụ thuộc PYTHONHASHSEED)."""
+    if shards <= 1:
+        return 0
+    return zlib.crc32(normalize_did(device_id).encode("utf-8")) % shards
+
+
+class DeviceRegistry:
+    def __init__(self, api, opts: Dict[str, Any], path: str = REGISTRY_PATH) -> None:
+        self.api = api
+        self.opt = opts or {}
+        self.path = path
+        self.reconcile_interval = int(self.opt.get("device_reconcile_interval", 3600))
+        self._lock = threading.Lock()
+        self._devices: Dict[str, Dict[str, Any]] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._mtime = 0.0
+        self._load()
+
+    def reload(self, opts: Dict[str, Any], reset: bool = False) -> None:
+        """
+        Options mới sau khi login lại (include_devices, chu kỳ đối soát); thread nền giữ nguyên.
+        reset: đổi tài khoản -> bỏ toàn bộ device của tài khoản cũ (đối soát lại từ đầu).
+        """
+        self.opt = opts or {}
+        self.reconcile_interval = int(self.opt.get("device_reconcile_interval", 3600))
+        if reset:
+            with self._lock:
+                self._devices = {}
+                self._save()
+
+    # ---------------- persistence ----------------
+    def _load(self) -> None:
+        try:
+            self._mtime = os.path.getmtime(self.path)
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            devices: Dict[str, Dict[str, Any]] = {}
+            for d in data.get("devices", []):
+                if isinstance(d, dict) and d.get("device_id"):
+                    devices[normalize_did(d["device_id"])] = d
+            self._devices = devices
+        except Exception:
+            pass
+
+    def refresh(self) -> None:
+        """Nạp lại file nếu process khác (poller shard 0) vừa ghi."""
+        try:
+            if os.path.getmtime(self.path) != self._mtime:
+                self._load()
+        except OSError:
+            pass
+
+    def _save(self) -> None:
+        data = {"updated_at": int(time.time()), "devices": list(self._devices.values())}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+    # ---------------- tra cứu (O(1), không gọi server) ----------------
+    def resolve(self, x: str) -> Optional[str]:
+        """Trả deviceId thật trên server, None nếu chưa biết."""
+        d = self._devices.get(normalize_did(x or ""))
+        return d.get("device_id") if d else None
+
+    def get(self, x: str) -> Dict[str, Any]:
+        return dict(self._devices.get(normalize_did(x or "")) or {})
+
+    def ids(self) -> List[str]:
+        return [d["device_id"] for d in self._devices.values()]
+
+    def wanted(self) -> List[str]:
+        """Thiết bị chỉ định trong options: device_suffixes rồi include_devices."""
+        want: List[str] = []
+        suffixes = (self.opt.get("device_suffixes") or "").strip()
+        if suffixes:
+            for s in [p.strip() for p in suffixes.replace(";", ",").split(",") if p.strip()]:
+                want.append(normalize_did(s))
+        inc = self.opt.get("include_devices") or []
+        if isinstance(inc, list):
+            for x in inc:
+                if isinstance(x, str) and x.strip() and x.strip().lower() != "all":
+                    want.append(normalize_did(x))
+        return list(dict.fromkeys(want))
+
+    def selected(self) -> List[str]:
+        """Danh sách device cần poll: theo options nếu có, ngược lại tất cả đã biết."""
+        want = self.wanted()
+        if want:
+            return [self.resolve(w) or w for w in want]
+        return self.ids()
+
+    def pick(self) -> Optional[str]:
+        """Chọn 1 device: theo options -> owner == uid -> last_seen mới nhất."""
+        for w in self.wanted():
+            did = self.resolve(w)
+            if did:
+                return did
+        devs = list(self._devices.values())
+        uid = getattr(self.api, "uid", None)
+        for d in devs:
+            if uid and d.get("owner_uid") == uid:
+                return d["device_id"]
+        if not devs:
+            return None
+        best = devs[0]
+        for d in devs:
+            if str(d.get("last_seen") or "") > str(best.get("last_seen") or ""):
+                best = d
+        return best["device_id"]
+
+    # ---------------- đối soát với server ----------------
+    def update_from_rows(self, rows: List[Dict[str, Any]], prune: bool = False) -> None:
+        """prune: rows là danh sách đầy đủ từ server -> bỏ device server không còn liệt kê."""
+        with self._lock:
+            if prune:
+                keep = {normalize_did(r.get("deviceId") or r.get("device_id") or "") for r in rows}
+                gone = [k for k in self._devices if k not in keep]
+                for k in gone:
+                    del self._devices[k]
+                if gone:
+                    print("[registry] removed", len(gone), "devices no longer listed upstream:", gone)
+            for r in rows:
+                did = r.get("deviceId") or r.get("device_id")
+                if not isinstance(did, str) or not did.strip():
+                    continue
+                key = normalize_did(did)
+                cur = self._devices.get(key) or {}
+                seen = str(r.get("updatedAt") or r.get("createdAt") or "")
+                if cur and seen and seen < str(cur.get("last_seen") or ""):
+                    continue
+                self._devices[key] = {
+                    "device_id": did.strip(),
+                    "owner_uid": r.get("userId") or cur.get("owner_uid"),
+                    "last_seen": seen or cur.get("last_seen"),
+                    "firmware": r.get("firmware") or r.get("fw") or r.get("version") or cur.get("firmware"),
+                }
+            self._save()
+
+    def reconcile(self) -> List[Dict[str, Any]]:
+        try:
+            rows = self.api.list_devices() or []
+            # list rỗng = lỗi / chưa login (không phân biệt được với tài khoản 0 device) -> không prune
+            if rows:
+                self.update_from_rows(rows, prune=True)
+                print("[registry] reconciled", len(self._devices), "devices")
+            return rows
+        except Exception as e:
+            print("[registry] reconcile error:", e)
+            return []
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.reconcile_interval)
+            self.reconcile()
+
+    def start(self, reconcile_now: bool = True) -> None:
+        """Đối soát ngay nếu registry trống (reconcile_now), sau đó chạy nền định kỳ."""
+        if reconcile_now and not self._devices:
+            self.reconcile()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Lịch sử mẫu theo device để export.
+- Coordinator ghi mỗi mẫu mới vào /data/history/<device>/<YYYY-MM-DD>.jsonl (append-only)
+- Export đọc tuần tự từng file/dòng trong khoảng [from, to] bằng generator,
+  bộ nhớ không phụ thuộc độ dài khoảng thời gian
+- Định dạng: csv, influx (line protocol), parquet (nếu có pyarrow)
+"""
+
+from __future__ import annotations
+
+import csv, io, json, os, shutil, threading, time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+from mapping import GTI_SENSORS, GRID_SENSORS, TIEUTHU_SENSORS, DAILY_KEYS, MONTHLY_KEYS
+
+HISTORY_DIR = "/data/history"
+COLUMNS = list(GTI_SENSORS) + list(GRID_SENSORS) + list(TIEUTHU_SENSORS) + DAILY_KEYS + MONTHLY_KEYS
+CHUNK = 64 * 1024       # gom output thành khối ~64KB cho response chunked
+PARQUET_ROWS = 5000     # số dòng / row group parquet
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # không có wheel cho mọi arch -> parquet là tuỳ chọn
+    pa = pq = None
+
+
+def parquet_available() -> bool:
+    return pq is not None
+
+
+def _day(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def _safe(device_id: str) -> str:
+    return "".join(ch for ch in device_id if ch.isalnum() or ch in "-_") or "_"
+
+
+class HistoryStore:
+    def __init__(self, path: str = HISTORY_DIR, retention_days: int = 90) -> None:
+        self.path = path
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._pruned_day = ""
+
+    # ---------------- ghi ----------------
+    def append(self, device_id: str, st: Dict[str, Any], ts: Optional[float] = None) -> None:
+        ts = time.time() if ts is None else ts
+        row = {"ts": round(ts, 3)}
+        for k in COLUMNS:
+            if k in st:
+                row[k] = st[k]
+        d = os.path.join(self.path, _safe(device_id))
+        day = _day(ts)
+        with self._lock:
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, f"{day}.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(row, separators=(",", ":")) + "\n")
+            if day != self._pruned_day:
+                self._pruned_day = day
+                self._prune(ts)
+
+    def _prune(self, now: float) -> None:
+        cutoff = _day(now - self.retention_days * 86400)
+        for dev in os.listdir(self.path):
+            d = os.path.join(self.path, dev)
+            for name in os.listdir(d) if os.path.isdir(d) else []:
+                if name.endswith(".jsonl") and name[:-6] < cutoff:
+                    os.remove(os.path.join(d, name))
+            if os.path.isdir(d) and not os.listdir(d):
+                shutil.rmtree(d, ignore_errors=True)
+
+    # ---------------- đọc ----------------
+    def devices(self) -> List[str]:
+        try:
+            return sorted(n for n in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, n)))
+        except OSError:
+            return []
+
+    def iter_rows(self, device_id: str, t_from: float, t_to: float) -> Iterator[Dict[str, Any]]:
+        """Từng mẫu trong [t_from, t_to), theo thứ tự thời gian; chỉ giữ 1 dòng trong bộ nhớ."""
+        d = os.path.join(self.path, _safe(device_id))
+        day = datetime.fromtimestamp(t_from, tz=timezone.utc).date()
+        last = datetime.fromtimestamp(t_to, tz=timezone.utc).date()
+        while day <= last:
+            p = os.path.join(d, f"{day.isoformat()}.jsonl")
+            if os.path.exists(p):
+                with open(p, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            row = json.loads(line)
+                        except ValueError:
+                            continue  # dòng ghi dở
+                        if t_from <= row.get("ts", 0) < t_to:
+                            yield row
+            day += timedelta(days=1)
+
+
+# ---------------- encoders (generator, xuất theo khối) ----------------
+def _chunked(parts: Iterator[str]) -> Iterator[bytes]:
+    buf: List[str] = []
+    size = 0
+    for s in parts:
+        buf.append(s)
+        size += len(s)
+        if size >= CHUNK:
+            yield "".join(buf).encode("utf-8")
+            buf, size = [], 0
+    if buf:
+        yield "".join(buf).encode("utf-8")
+
+
+def export_csv(store: HistoryStore, device_ids: List[str], t_from: float, t_to: float) -> Iterator[bytes]:
+    def lines():
+        out = io.StringIO()
+        w = csv.writer(out)
+        w.writerow(["time", "device_id"] + COLUMNS)
+        for did in device_ids:
+            for row in store.iter_rows(did, t_from, t_to):
+                t = datetime.fromtimestamp(row["ts"], tz=timezone.utc).isoformat()
+                w.writerow([t, did] + [row.get(k, "") for k in COLUMNS])
+                if out.tell() >= 4096:
+                    yield out.getvalue()
+                    out.seek(0)
+                    out.truncate()
+        yield out.getvalue()
+    return _chunked(lines())
+
+
+def _tag(v: str) -> str:
+    return v.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def export_influx(store: HistoryStore, device_ids: List[str], t_from: float, t_to: float,
+                  measurement: str = "gti") -> Iterator[bytes]:
+    def lines():
+        for did in device_ids:
+            prefix = f"{measurement},device={_tag(did)} "
+            for row in store.iter_rows(did, t_from, t_to):
+                fields = ",".join(f"{k}={float(row[k])}" for k in COLUMNS
+                                  if isinstance(row.get(k), (int, float)) and not isinstance(row.get(k), bool))
+                if fields:
+                    yield f"{prefix}{fields} {int(round(row['ts'] * 1000)) * 1_000_000}\n"
+    return _chunked(lines())
+
+
+class _StreamSink(io.RawIOBase):
+    """File ảo cho ParquetWriter: tell() tính tổng byte đã ghi, dữ liệu lấy ra được sau mỗi flush."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.buf = bytearray()
+        self.pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.buf += b
+        self.pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def drain(self) -> bytes:
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
+
+
+def export_parquet(store: HistoryStore, device_ids: List[str], t_from: float, t_to: float) -> Iterator[bytes]:
+    """Ghi parquet theo row group PARQUET_ROWS dòng; trả từng phần bytes ngay khi flush."""
+    schema = pa.schema([("time", pa.timestamp("ms", tz="UTC")), ("device_id", pa.string())]
+                       + [(k, pa.float64()) for k in COLUMNS])
+    sink = _StreamSink()
+    writer = pq.ParquetWriter(sink, schema)
+    drain = sink.drain
+
+    def flush(batch: List[Dict[str, Any]], did: str) -> None:
+        cols = {"time": [int(r["ts"] * 1000) for r in batch], "device_id": [did] * len(batch)}
+        for k in COLUMNS:
+            cols[k] = [float(r[k]) if isinstance(r.get(k), (int, float)) else None for r in batch]
+        writer.write_table(pa.table(cols, schema=schema))
+
+    for did in device_ids:
+        batch: List[Dict[str, Any]] = []
+        for row in store.iter_rows(did, t_from, t_to):
+            batch.append(row)
+            if len(batch) >= PARQUET_ROWS:
+                flush(batch, did)
+                batch = []
+                yield drain()
+        if batch:
+            flush(batch, did)
+            yield drain()
+    writer.close()
+    yield drain()
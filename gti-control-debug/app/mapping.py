@@ -22,3 +22,13 @@ TIEUTHU_SENSORS = {
 
 DAILY_KEYS   = ["energy_daily","grid_energy_daily","tieuthu_energy_daily"]
 MONTHLY_KEYS = ["energy_monthly","grid_energy_monthly","tieuthu_energy_monthly"]
+
+# sensor tổng hợp toàn fleet (device ảo "fleet", topic gti/fleet/state)
+FLEET_SENSORS = {
+    "total_pv_power":          ("Fleet - Tổng công suất PV", "W", "power", "measurement"),
+    "grid_import_power":       ("Fleet - Công suất lấy lưới", "W", "power", "measurement"),
+    "consumption_power":       ("Fleet - Công suất tiêu thụ", "W", "power", "measurement"),
+    "self_consumption_ratio":  ("Fleet - Tỉ lệ tự dùng", None, None, "measurement"),
+    "anomaly_count":           ("Fleet - Số thiết bị bất thường", None, None, "measurement"),
+    "devices":                 ("Fleet - Số thiết bị", None, None, "measurement")
+}
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Hàng đợi trên đĩa cho state khi broker MQTT của HA không kết nối được.
+- Ghi nối tiếp (append-only) vào các segment /data/mqtt_buffer/seg-<n>.jsonl
+- Giới hạn tổng dung lượng: vượt quá thì xoá segment cũ nhất (ring buffer)
+- Khi kết nối lại: replay (tuỳ chọn gộp còn bản mới nhất mỗi topic), giới hạn tốc độ
+"""
+
+from __future__ import annotations
+
+import json, os, threading, time
+from typing import Callable, List, Tuple
+
+BUFFER_DIR = "/data/mqtt_buffer"
+
+Message = Tuple[str, str, bool]  # (topic, payload, retain)
+
+
+class OfflineBuffer:
+    def __init__(self, path: str = BUFFER_DIR, max_bytes: int = 8 * 1024 * 1024,
+                 segment_bytes: int = 512 * 1024) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._replaying = False
+        os.makedirs(self.path, exist_ok=True)
+
+    # ---------------- segments ----------------
+    def _segments(self) -> List[str]:
+        names = [n for n in os.listdir(self.path) if n.startswith("seg-") and n.endswith(".jsonl")]
+        names.sort(key=lambda n: int(n[4:-6]))
+        return [os.path.join(self.path, n) for n in names]
+
+    def _size(self, segs: List[str]) -> int:
+        total = 0
+        for p in segs:
+            try:
+                total += os.path.getsize(p)
+            except OSError:
+                pass
+        return total
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._size(self._segments())
+
+    def append(self, topic: str, payload: str, retain: bool = False) -> None:
+        line = json.dumps({"t": topic, "p": payload, "r": retain, "ts": time.time()}, ensure_ascii=False) + "\n"
+        with self._lock:
+            segs = self._segments()
+            cur = segs[-1] if segs else os.path.join(self.path, "seg-0.jsonl")
+            if segs and os.path.getsize(cur) + len(line) > self.segment_bytes:
+                cur = os.path.join(self.path, f"seg-{int(os.path.basename(cur)[4:-6]) + 1}.jsonl")
+                segs.append(cur)
+            with open(cur, "a", encoding="utf-8") as f:
+                f.write(line)
+            if not segs:
+                segs = [cur]
+            # bounded: bỏ segment cũ nhất (giữ lại segment đang ghi)
+            while len(segs) > 1 and self._size(segs) > self.max_bytes:
+                os.remove(segs.pop(0))
+
+    def take(self, collapse: bool = True) -> List[Message]:
+        """Lấy toàn bộ message đang chờ (theo thứ tự ghi) và xoá segment."""
+        with self._lock:
+            segs = self._segments()
+            out: List[Message] = []
+            for p in segs:
+                try:
+                    with open(p, "r", encoding="utf-8") as f:
+                        for line in f:
+                            try:
+                                m = json.loads(line)
+                                out.append((m["t"], m["p"], bool(m.get("r"))))
+                            except Exception:
+                                continue  # dòng ghi dở khi mất điện
+                except OSError:
+                    pass
+            for p in segs:
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+        if collapse:
+            latest = {}
+            for m in out:
+                latest.pop(m[0], None)
+                latest[m[0]] = m
+            out = list(latest.values())
+        return out
+
+    # ---------------- replay ----------------
+    @property
+    def replaying(self) -> bool:
+        return self._replaying
+
+    def replay(self, publish: Callable[[str, str, bool], bool], rate: float = 20.0, collapse: bool = True) -> None:
+        """
+        Replay trong thread nền, tối đa `rate` message/giây.
+        Trong lúc replay, caller nên append() message mới thay vì publish thẳng
+        (giữ đúng thứ tự retained); vòng replay lặp tới khi hàng đợi rỗng.
+        publish trả False -> ghi lại phần còn lại và dừng.
+        """
+        with self._lock:
+            if self._replaying:
+                return
+            self._replaying = True
+
+        def _run():
+            gap = 1.0 / rate if rate > 0 else 0.0
+            try:
+                while True:
+                    with self._lock:
+                        if not self._segments():
+                            self._replaying = False
+                            return
+                    msgs = self.take(collapse)
+                    print(f"[buffer] replay {len(msgs)} messages at {rate}/s")
+                    for i, (topic, payload, retain) in enumerate(msgs):
+                        if not publish(topic, payload, retain):
+                            # ghi lại trước các message mới hơn đã append trong lúc replay
+                            rest = msgs[i:] + self.take(collapse=False)
+                            for m in rest:
+                                self.append(*m)
+                            self._replaying = False
+                            print(f"[buffer] replay interrupted, {len(rest)} re-queued")
+                            return
+                        if gap:
+                            time.sleep(gap)
+            except Exception as e:
+                self._replaying = False
+                print("[buffer] replay error:", e)
+
+        threading.Thread(target=_run, daemon=True).start()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Nguồn dữ liệu tức thời cho Coordinator (chọn bằng option mqtt_device_source).
+- "rest": decode bản ghi mới nhất từ /api/inverter/data (APIClient.read_state_server)
+- "mqtt": subscribe broker của thiết bị (device_mqtt_*), giữ bản tin telemetry mới nhất
+DeviceMqttSource cũng là kết nối cho lệnh gửi thẳng xuống thiết bị (commands.py):
+publish() + listeners nhận mọi bản tin telemetry để đối chiếu ack.
+Cả 2 trả dict {sensor_key: value, ...}; thiếu key thì Coordinator điền 0.
+"""
+
+from __future__ import annotations
+
+import json, os, threading, time, uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from paho.mqtt.client import Client, MQTT_ERR_SUCCESS
+
+from mapping import GTI_SENSORS, GRID_SENSORS, TIEUTHU_SENSORS, DAILY_KEYS, MONTHLY_KEYS
+from device_registry import normalize_did
+
+SENSOR_KEYS = frozenset(list(GTI_SENSORS) + list(GRID_SENSORS) + list(TIEUTHU_SENSORS) + DAILY_KEYS + MONTHLY_KEYS)
+
+# topic telemetry trên broker thiết bị; {device_id} = GTIControlXXX
+DEVICE_STATE_TOPIC = "{device_id}/state"
+
+
+def decode_payload(payload: Any) -> Dict[str, Any]:
+    """Bản ghi server / bản tin thiết bị (JSON) -> dict chỉ gồm các key sensor đã biết."""
+    st: Dict[str, Any] = {}
+    if isinstance(payload, dict):
+        for src in (payload.get("raw"), payload):
+            if isinstance(src, dict):
+                for k, v in src.items():
+                    if k in SENSOR_KEYS and k not in st:
+                        st[k] = v
+    return st
+
+
+class RestSource:
+    name = "rest"
+
+    def __init__(self, api_client) -> None:
+        self.api = api_client
+
+    def start(self) -> None:
+        pass
+
+    def read(self, device_id: str, srv: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """srv: bản ghi Coordinator đã đọc trong vòng này (tránh gọi server 2 lần)."""
+        if srv is None:
+            if not self.api.server_enabled:
+                return {}
+            srv = self.api.read_state_server(device_id) or {}
+        return decode_payload(srv) if srv else {}
+
+
+class DeviceMqttSource:
+    name = "mqtt"
+
+    def __init__(self, options: Dict[str, Any], fallback: Optional[RestSource] = None,
+                 topic: str = DEVICE_STATE_TOPIC, tls: Optional[bool] = None) -> None:
+        self.opt = options
+        # TLS: cổng device_mqtt_tls_port (mặc định 8883) thay cho device_mqtt_port
+        self.tls = bool(options.get("device_mqtt_tls", False)) if tls is None else tls
+        self.fallback = fallback
+        self.topic = topic
+        self.stale_after = 3 * int(options.get("scan_interval", 30))
+        self.client: Optional[Client] = None
+        self._latest: Dict[str, Any] = {}  # device -> (ts, state), chỉ device đang theo dõi
+        self._topics: Dict[str, str] = {}   # device -> topic đã subscribe
+        self._lock = threading.Lock()
+        # listener(device_id, payload) gọi trên network thread của paho -> phải nhanh
+        self.listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+
+    def _device_of(self, topic: str) -> Optional[str]:
+        # khớp template với topic thật để lấy device_id
+        pre, _, post = self.topic.partition("{device_id}")
+        if not (topic.startswith(pre) and topic.endswith(post)):
+            return None
+        did = topic[len(pre):len(topic) - len(post)] if post else topic[len(pre):]
+        return normalize_did(did) if did and "/" not in did else None
+
+    def _on_message(self, client, userdata, msg) -> None:
+        did = self._device_of(msg.topic)
+        if not did or did not in self._topics:
+            return
+        try:
+            payload = json.loads(msg.payload.decode("utf-8", "replace") or "{}")
+        except ValueError:
+            return
+        if not isinstance(payload, dict):
+            return
+        st = decode_payload(payload)
+        with self._lock:
+            self._latest[did] = (time.time(), st)
+        for fn in self.listeners:
+            fn(did, payload)
+
+    def _on_connect(self, client, userdata, flags, rc) -> None:
+        if rc != 0:
+            return
+        with self._lock:
+            topics = list(self._topics.values())
+        if topics:
+            client.subscribe([(t, 0) for t in topics])
+
+    def set_devices(self, device_ids: List[str]) -> None:
+        """
+        Chỉ subscribe topic của các device thuộc tài khoản / shard này (từ registry):
+        broker của hãng dùng chung, "+/state" sẽ nhận telemetry của mọi khách hàng.
+        """
+        want = {d: self.topic.replace("{device_id}", d) for d in device_ids}
+        with self._lock:
+            if want == self._topics:
+                return
+            add = [t for d, t in want.items() if d not in self._topics]
+            drop = [t for d, t in self._topics.items() if d not in want]
+            self._topics = want
+            for d in [d for d in self._latest if d not in want]:
+                del self._latest[d]
+        if self.connected():
+            if drop:
+                self.client.unsubscribe(drop)
+            if add:
+                self.client.subscribe([(t, 0) for t in add])
+
+    def start(self) -> None:
+        host = self.opt.get("device_mqtt_host")
+        if not host or self.client is not None:
+            return
+        # pid + ngẫu nhiên: các shard (run_mode split) khởi động cùng giây không đá nhau khỏi broker
+        c = Client(client_id=f"gti-control-dev-{os.getpid()}-{uuid.uuid4().hex[:6]}")
+        if self.opt.get("device_mqtt_username"):
+            c.username_pw_set(self.opt["device_mqtt_username"], self.opt.get("device_mqtt_password"))
+        if self.tls:
+            c.tls_set()  # CA hệ thống; mật khẩu + setpoint không đi dạng plaintext
+        c.on_message = self._on_message
+        c.on_connect = self._on_connect
+        c.reconnect_delay_set(min_delay=1, max_delay=60)
+        port = int(self.opt.get("device_mqtt_tls_port", 8883)) if self.tls else int(self.opt.get("device_mqtt_port", 1883))
+        c.connect_async(host, port, keepalive=60)
+        c.loop_start()
+        self.client = c
+        print("[source] device MQTT", host, port, "topic", self.topic, "(tls)" if self.tls else "")
+
+    def connected(self) -> bool:
+        return self.client is not None and self.client.is_connected()
+
+    def publish(self, topic: str, payload: str, qos: int = 1) -> bool:
+        if not self.connected():
+            return False
+        return self.client.publish(topic, payload, qos=qos).rc == MQTT_ERR_SUCCESS
+
+    def read(self, device_id: str, srv: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        with self._lock:
+            hit = self._latest.get(device_id)
+        if hit is not None and time.time() - hit[0] <= self.stale_after:
+            return dict(hit[1])
+        # chưa có / quá cũ telemetry trực tiếp -> dùng bản ghi REST (nếu có)
+        return self.fallback.read(device_id, srv) if self.fallback else {}
+
+
+def make_source(options: Dict[str, Any], api_client):
+    if options.get("mqtt_device_source", "rest") == "mqtt" and options.get("device_mqtt_host"):
+        return DeviceMqttSource(options, fallback=RestSource(api_client),
+                                topic=options.get("device_mqtt_state_topic") or DEVICE_STATE_TOPIC)
+    return RestSource(api_client)
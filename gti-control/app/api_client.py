@@ -4,11 +4,29 @@ import json
 import time
 import threading
 import requests
-from typing import Dict, Any, Optional, List
+from dateutil.parser import isoparse
+from urllib.parse import quote, urlsplit
+from datetime import datetime, timezone
+from typing import Dict, Any, Iterator, Optional, List
+
+from rate_limiter import BUDGET_PATH, RateLimiter, RateLimited, parse_retry_after
+from profiler import span
+from device_registry import normalize_did
 
 OPTIONS_PATH = "/data/options.json"
 USER_PATH = "/data/user_options.json"
 
+# endpoint điều khiển / lịch (cùng họ với /api/inverter/data)
+SCHEDULE_PATH = "/api/inverter/schedule"
+CONTROL_PATH = "/api/inverter/control"
+HISTORY_PAGE = 500       # bản ghi / trang khi đọc lịch sử (backfill)
+HISTORY_MAX_PAGES = 200
+
+
+class HistoryIncomplete(Exception):
+    """read_history không đọc hết được khoảng yêu cầu (HTTP lỗi, body hỏng, quá số trang)."""
+
+
 def load_options() -> Dict[str, Any]:
     with open(OPTIONS_PATH, "r", encoding="utf-8") as f:
         j = json.load(f)
@@ -20,6 +38,65 @@ def load_options() -> Dict[str, Any]:
     return j
 
 
+def _row_ts(row: Dict[str, Any]) -> str:
+    return row.get("updatedAt") or row.get("createdAt") or ""
+
+
+def _epoch(ts: str) -> Optional[float]:
+    """ISO 8601 -> epoch giây (không có múi giờ thì coi là UTC); None nếu không đọc được."""
+    try:
+        dt = isoparse(ts)
+    except (ValueError, OverflowError):
+        return None
+    return (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
+
+
+def row_epoch(row: Dict[str, Any]) -> Optional[float]:
+    """updatedAt/createdAt (ISO 8601) -> epoch giây; None nếu không đọc được."""
+    return _epoch(_row_ts(row))
+
+
+def _newer(ts: Optional[float], wm: Optional[float]) -> bool:
+    """So theo epoch: chuỗi ISO khác múi giờ / khác số chữ số thập phân không so lexical được."""
+    return ts is not None and (wm is None or ts > wm)
+
+
+def parse_values(value: Any) -> List[float]:
+    """'12.5#230#...' -> [12.5, 230.0, ...] (bỏ phần rỗng / không phải số)."""
+    out: List[float] = []
+    if isinstance(value, str):
+        for p in value.split("#"):
+            try:
+                out.append(float(p))
+            except ValueError:
+                continue
+    return out
+
+
+def _rows_of(j: Any) -> List[Dict[str, Any]]:
+    """
+    Body /api/inverter/data -> list bản ghi. Server có nhiều kiểu trả:
+    {"data": [{...}, ...]}, {"data": {...}}, {"raw": {...}, "values": [...]} hoặc list trần.
+    """
+    if isinstance(j, dict):
+        node = j.get("data")
+        if node is None and isinstance(j.get("raw"), dict):
+            node = j["raw"]
+        j = [node] if isinstance(node, dict) else node
+    return [r for r in j if isinstance(r, dict)] if isinstance(j, list) else []
+
+
+def _newest_row(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Chọn bản ghi mới nhất (theo epoch) trong 1 lượt duyệt (không sort cả list)."""
+    best = rows[0]
+    best_ts = row_epoch(best)
+    for r in rows:
+        ts = row_epoch(r)
+        if _newer(ts, best_ts):
+            best, best_ts = r, ts
+    return best
+
+
 class APIClient:
     """Client lo phần login + gọi REST tới server giabao-inverter."""
 
@@ -30,12 +107,23 @@ class APIClient:
         self.api_key = opts.get("firebase_api_key") or ""
         self.server_enabled = bool(opts.get("server_enabled", True))
         self.s = requests.Session()
+        # ngân sách request chung cho poller, UI và lệnh điều khiển (mọi process, qua BUDGET_PATH)
+        self.limiter = RateLimiter(float(opts.get("api_rate_per_minute", 60)), path=BUDGET_PATH)
+        self.priority = self.limiter.priority
 
         self._lock = threading.Lock()
         self.id_token: Optional[str] = None
         self.uid: Optional[str] = None
         self.exp_at: int = 0  # epoch seconds
 
+        # watermark updatedAt theo device -> bỏ qua decode/publish khi không có bản ghi mới
+        self._watermarks: Dict[str, str] = {}
+        self._last_state: Dict[str, Dict[str, Any]] = {}
+        # theo device: server có hiểu ?since= không (None = chưa biết); lần đọc gần nhất có bản ghi
+        # đến từ fallback ?uid= không (id dạng khác server) -> không được bỏ qua fallback
+        self._since_ok: Dict[str, Optional[bool]] = {}
+        self._via_uid: Dict[str, bool] = {}
+
         # nạp cache nếu có
         if os.path.exists(USER_PATH):
             try:
@@ -46,6 +134,26 @@ class APIClient:
             except Exception:
                 pass
 
+    def reload(self, opts: Dict[str, Any]) -> bool:
+        """
+        Login lại từ UI: đổi thông tin đăng nhập tại chỗ (coordinator, source, registry, backfill
+        giữ đúng object này và limiter của nó). Trả True nếu tài khoản / server đổi.
+        """
+        creds = ((opts.get("server_base_url") or "").rstrip("/"), opts.get("email") or "",
+                 opts.get("password") or "", opts.get("firebase_api_key") or "")
+        with self._lock:
+            changed = creds != (self.base, self.email, self.password, self.api_key)
+            self.base, self.email, self.password, self.api_key = creds
+            self.server_enabled = bool(opts.get("server_enabled", True))
+            if changed:
+                # token / watermark của tài khoản cũ không còn dùng được
+                self.id_token, self.uid, self.exp_at = None, None, 0
+                self._watermarks.clear()
+                self._last_state.clear()
+                self._since_ok.clear()
+                self._via_uid.clear()
+        return changed
+
     # ---------- nội bộ ----------
     def _save_cache(self, id_token: str, uid: str, expires_in: int) -> None:
         self.id_token = id_token
@@ -61,6 +169,21 @@ class APIClient:
         with open(USER_PATH, "w", encoding="utf-8") as f:
             json.dump(save, f, ensure_ascii=False, indent=2)
 
+    def _request(self, method: str, url: str, **kw) -> requests.Response:
+        """Mọi request tới server đi qua token bucket; 429/503 -> tôn trọng Retry-After."""
+        prio = self.limiter.current
+        with span("rate_wait", prio=prio):
+            ok = self.limiter.acquire(prio)
+        if not ok:
+            raise RateLimited(f"request budget exhausted (priority {prio})")
+        with span("http", method=method, path=urlsplit(url).path):
+            r = self.s.request(method, url, **kw)
+        if r.status_code in (429, 503):
+            wait = parse_retry_after(r.headers.get("Retry-After"))
+            self.limiter.penalize(wait)
+            print("[api] server rate limit, retry after", round(wait, 1), "s")
+        return r
+
     def _token_valid(self) -> bool:
         # còn >60s coi như hợp lệ
         return bool(self.id_token) and (time.time() < (self.exp_at - 60))
@@ -90,7 +213,8 @@ class APIClient:
             }
             try:
                 print(f"[api] POST {url}?key={self.api_key[:6]}…{self.api_key[-4:]}")
-                r = self.s.post(url, params=params, json=payload, timeout=20)
+                with span("login"):
+                    r = self.s.post(url, params=params, json=payload, timeout=20)
                 print("[api] ->", r.status_code)
                 if not r.ok:
                     # không log token hay thông tin nhạy cảm
@@ -110,14 +234,46 @@ class APIClient:
                 print("[api] login exception:", e)
                 return False
 
-    def read_state_server(self, device_hint: str) -> Dict[str, Any]:
+    def list_devices(self) -> List[Dict[str, Any]]:
+        """Danh sách bản ghi thiết bị của user (deviceId, userId, updatedAt...)."""
+        if not self.login():
+            return []
+        url = f"{self.base}/api/inverter/data?uid={self.uid}&deviceId=all"
+        h = {
+            "Authorization": f"Bearer {self.id_token}",
+            "Accept": "application/json",
+        }
+        try:
+            r = self._request("GET", url, headers=h, timeout=30)
+            print("[api] GET", url)
+            print("[api] ->", r.status_code)
+            if not r.ok:
+                return []
+            j = r.json()
+        except RateLimited:
+            raise
+        except Exception as e:
+            print("[api] list_devices exception:", e)
+            return []
+        # API có 2 kiểu: {data:[{...},...]} hoặc trả thẳng list
+        if isinstance(j, dict) and isinstance(j.get("data"), list):
+            return j["data"]
+        return j if isinstance(j, list) else []
+
+    def read_state_server(self, device_hint: str, peek: bool = False) -> Dict[str, Any]:
         """
         Lấy bản ghi mới nhất cho user từ server.
         Ưu tiên: /api/inverter/data?uid=<uid>&deviceId=<device_hint>
         Fallback: /api/inverter/data?uid=<uid>
-        Trả về dict rỗng nếu không có dữ liệu.
+        Nếu đã có watermark updatedAt cho device thì gửi kèm &since=<watermark>;
+        server không hiểu tham số này thì tự tắt và chỉ lọc phía client.
+        Trả về dict rỗng nếu không có dữ liệu; "changed": False nếu bản ghi mới nhất
+        trùng với lần đọc trước.
+        Watermark / "changed" là của poller (Coordinator). UI / debug gọi với peek=True:
+        luôn đọc bản ghi mới nhất, không dùng và không đổi watermark (không "ăn" mẫu của poller).
         """
-        if not self.login():
+        # server_enabled: false -> login() trả True nhưng không có uid/token: không gọi upstream
+        if not self.server_enabled or not self.login():
             return {}
 
         def _get(url: str) -> Optional[Dict[str, Any]]:
@@ -125,7 +281,7 @@ class APIClient:
                 "Authorization": f"Bearer {self.id_token}",
                 "Accept": "application/json",
             }
-            r = self.s.get(url, headers=h, timeout=15)
+            r = self._request("GET", url, headers=h, timeout=15)
             print("[api] GET", url)
             print("[api] ->", r.status_code)
             if not r.ok:
@@ -135,30 +291,147 @@ class APIClient:
             except Exception:
                 return None
 
+        # watermark giữ nguyên chuỗi server trả (gửi lại qua ?since=), so sánh thì theo epoch
+        wm = "" if peek else self._watermarks.get(device_hint, "")
+        wm_ts = _epoch(wm) if wm else None
+        since_ok = self._since_ok.get(device_hint)
+        since = f"&since={quote(wm)}" if (wm and since_ok is not False) else ""
+
         base = self.base.rstrip("/")
         # 1) theo device_hint (gti283 / 283)
-        url1 = f"{base}/api/inverter/data?uid={self.uid}&deviceId={device_hint}"
+        url1 = f"{base}/api/inverter/data?uid={self.uid}&deviceId={device_hint}{since}"
         j = _get(url1)
-        rows: List[Dict[str, Any]] = j.get("data", []) if isinstance(j, dict) else []
+        rows = _rows_of(j)
 
-        # 2) fallback theo uid
-        if not rows:
-            url2 = f"{base}/api/inverter/data?uid={self.uid}"
+        # 2) fallback theo uid: chỉ bỏ qua khi device này đọc được qua deviceId= và server
+        #    đã xác nhận (?since=) là không có bản ghi mới hơn
+        via_uid = False
+        if not rows and not (since and since_ok and not self._via_uid.get(device_hint)):
+            url2 = f"{base}/api/inverter/data?uid={self.uid}{since}"
             j2 = _get(url2)
-            rows = j2.get("data", []) if isinstance(j2, dict) else []
+            # ?uid= trả bản ghi của mọi device trong tài khoản: chỉ giữ đúng device này
+            # (không thì device lạ/cũ nhận dữ liệu của inverter khác)
+            want = normalize_did(device_hint)
+            rows = [r for r in _rows_of(j2) if normalize_did(str(r.get("deviceId") or "")) == want]
+            via_uid = bool(rows)
+
+        if rows and not peek:
+            self._via_uid[device_hint] = via_uid
+            if since:
+                # server bỏ qua ?since= nếu vẫn trả về bản ghi cũ
+                self._since_ok[device_hint] = all(_newer(row_epoch(r), wm_ts) for r in rows)
 
         if not rows:
+            if wm and device_hint in self._last_state:
+                return dict(self._last_state[device_hint], changed=False)
             return {}
 
-        rows.sort(key=lambda x: x.get("updatedAt") or x.get("createdAt") or "", reverse=True)
-        row = rows[0]
+        row = _newest_row(rows)
+        if wm and not _newer(row_epoch(row), wm_ts) and device_hint in self._last_state:
+            return dict(self._last_state[device_hint], changed=False)
+
         val = (row.get("value") or "").strip()
 
-        return {
+        out = {
             "deviceId": row.get("deviceId"),
             "userId": row.get("userId"),
             "createdAt": row.get("createdAt"),
             "updatedAt": row.get("updatedAt"),
             "value": val,
+            "values": parse_values(val),
             "raw": row,
-        }
\ No newline at end of file
+        }
+        if not peek:
+            self._watermarks[device_hint] = _row_ts(row)
+            self._last_state[device_hint] = out
+        return dict(out, changed=True)
+
+    def read_history(self, device_id: str, t_from: float, t_to: float,
+                     page_size: int = HISTORY_PAGE) -> Iterator[Dict[str, Any]]:
+        """
+        Bản ghi trong [t_from, t_to) theo trang (&from=&to=&page=&limit=), từng trang một.
+        Server bỏ qua phân trang (trang sau trùng trang trước / ngắn hơn limit) thì dừng;
+        bỏ qua from/to thì lọc lại phía client.
+        Trang lỗi (kể cả 429 vừa penalize) / body hỏng / vượt HISTORY_MAX_PAGES -> HistoryIncomplete
+        (RateLimited nếu hết ngân sách): caller không được coi khoảng này là đã đọc xong.
+        """
+        if not self.login():
+            raise HistoryIncomplete(f"{device_id}: login failed")
+        frm = datetime.fromtimestamp(t_from, tz=timezone.utc).isoformat()
+        to = datetime.fromtimestamp(t_to, tz=timezone.utc).isoformat()
+        first_prev = None
+        for page in range(1, HISTORY_MAX_PAGES + 1):
+            url = (f"{self.base}/api/inverter/data?uid={self.uid}&deviceId={device_id}"
+                   f"&from={quote(frm)}&to={quote(to)}&page={page}&limit={page_size}")
+            r = self._request("GET", url, headers=self._auth_headers(), timeout=30)
+            print("[api] GET history", device_id, "page", page, "->", r.status_code)
+            if not r.ok:
+                raise HistoryIncomplete(f"{device_id} page {page}: HTTP {r.status_code}")
+            try:
+                j = r.json()
+            except ValueError:
+                raise HistoryIncomplete(f"{device_id} page {page}: invalid JSON")
+            rows = _rows_of(j)
+            if not rows or rows[0] == first_prev:
+                return
+            first_prev = rows[0]
+            for row in rows:
+                ts = row_epoch(row)
+                if ts is not None and t_from <= ts < t_to:
+                    yield row
+            if len(rows) < page_size:
+                return
+        raise HistoryIncomplete(f"{device_id}: more than {HISTORY_MAX_PAGES} pages")
+
+    def _auth_headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.id_token}", "Accept": "application/json"}
+
+    def get_schedules(self, device_id: str) -> Dict[str, Any]:
+        """{"schedule1": {"start","end","cutoff_voltage","max_power"}, ...}; {} nếu lỗi."""
+        if not self.login():
+            return {}
+        url = f"{self.base}{SCHEDULE_PATH}?uid={self.uid}&deviceId={device_id}"
+        try:
+            r = self._request("GET", url, headers=self._auth_headers(), timeout=15)
+            print("[api] GET", url)
+            print("[api] ->", r.status_code)
+            if not r.ok:
+                return {}
+            j = r.json()
+        except RateLimited:
+            raise
+        except Exception as e:
+            print("[api] get_schedules exception:", e)
+            return {}
+        if isinstance(j, dict) and isinstance(j.get("data"), dict):
+            j = j["data"]
+        return j if isinstance(j, dict) else {}
+
+    def _control(self, device_id: str, payload: Dict[str, Any]) -> bool:
+        if not self.login():
+            return False
+        url = f"{self.base}{CONTROL_PATH}"
+        body = {"uid": self.uid, "deviceId": device_id, **payload}
+        try:
+            r = self._request("POST", url, headers=self._auth_headers(), json=body, timeout=15)
+            print("[api] POST", url, sorted(payload))
+            print("[api] ->", r.status_code)
+            return r.ok
+        except RateLimited:
+            raise
+        except Exception as e:
+            print("[api] control exception:", e)
+            return False
+
+    def set_cutoff_voltage(self, device_id: str, value: float) -> bool:
+        return self._control(device_id, {"cutoff_voltage": value})
+
+    def set_max_power(self, device_id: str, value: float) -> bool:
+        return self._control(device_id, {"max_power_limit": value})
+
+    def set_schedule(self, device_id: str, idx: int, start: str, end: str,
+                     cutoff_voltage: float, max_power: float) -> bool:
+        return self._control(device_id, {"schedule": {
+            "index": idx, "start": start, "end": end,
+            "cutoff_voltage": cutoff_voltage, "max_power": max_power,
+        }})
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Đường lệnh HA / UI -> thiết bị (cutoff_voltage, max_power_limit, lịch 1..3).
+- rest (mặc định): /api/inverter/control như trước
+- auto (bật tay, giao thức lệnh của firmware chưa được xác nhận): publish setpoint thẳng lên
+  broker thiết bị qua TLS (device_mqtt_command_topic, QoS 1); xong khi telemetry của chính
+  thiết bị echo lại giá trị mới (hoặc cmd_id). Quá device_command_timeout giây không thấy
+  echo -> gửi lại qua REST.
+Setpoint là idempotent: echo MQTT đến muộn sau khi REST đã gửi cũng không sao.
+Mỗi lệnh ghi độ trễ đầu-cuối (nhận lệnh -> echo / REST trả về): log, ring buffer,
+/data/traces/commands-<shard>.json (xem /debug/commands) và gti/<device>/cmd/result lên HA.
+"""
+
+from __future__ import annotations
+
+import json, os, re, threading, time, uuid
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from profiler import TRACE_DIR, span
+from rate_limiter import PRIO_COMMAND
+from state_record import to_float
+
+DEVICE_CMD_TOPIC = "{device_id}/cmd"
+# cùng khoảng với entity number (HaMqttSink.discover)
+LIMITS = {"cutoff_voltage": (0.0, 100.0), "max_power": (0.0, 5000.0)}
+ECHO_TOLERANCE = 0.051  # telemetry làm tròn 0.1 V / 0.1 W
+_HHMM = re.compile(r"(?:[01]?\d|2[0-3]):[0-5]\d(?::[0-5]\d)?\Z")
+_SAFE_DID = re.compile(r"[A-Za-z0-9_.-]+\Z")  # device_id vào topic: không cho / + #
+
+# on_result(device_id, result)
+ResultHandler = Callable[[str, Dict[str, Any]], None]
+
+
+def _check(key: str, value: Any) -> float:
+    lo, hi = LIMITS[key]
+    v = to_float(value)
+    if v is None or not lo <= v <= hi:
+        raise ValueError(f"{key}={value!r} ngoài khoảng [{lo:g}, {hi:g}]")
+    return v
+
+
+def _matches(expect: Dict[str, Any], payload: Dict[str, Any]) -> bool:
+    for k, want in expect.items():
+        got = payload.get(k)
+        if isinstance(want, float):
+            got = to_float(got)
+            if got is None or abs(got - want) > ECHO_TOLERANCE:
+                return False
+        elif got != want:
+            return False
+    return True
+
+
+class _Pending:
+    __slots__ = ("device_id", "cid", "expect", "event")
+
+    def __init__(self, device_id: str, cid: str, expect: Dict[str, Any]) -> None:
+        self.device_id = device_id
+        self.cid = cid
+        self.expect = expect
+        self.event = threading.Event()
+
+
+class CommandRouter:
+    """Cùng tên hàm set_* với APIClient -> Coordinator / UI gọi thay cho api_client."""
+
+    def __init__(self, api_client, options: Dict[str, Any], link=None, name: str = "shard0",
+                 path: str = TRACE_DIR, keep: int = 100, on_result: Optional[ResultHandler] = None) -> None:
+        self.api = api_client
+        # link: DeviceMqttSource TLS (Coordinator chọn: chung với source mqtt hoặc kết nối riêng)
+        self.link = link if options.get("command_transport", "rest") == "auto" else None
+        self.topic = options.get("device_mqtt_command_topic") or DEVICE_CMD_TOPIC
+        self.timeout = float(options.get("device_command_timeout", 5))
+        self.path = os.path.join(path, f"commands-{name}.json")
+        self.on_result = on_result
+        self.results: deque = deque(maxlen=keep)
+        self._pending: Dict[str, _Pending] = {}
+        self._lock = threading.Lock()
+        if self.link is not None:
+            self.link.listeners.append(self._on_telemetry)
+
+    @property
+    def transport(self) -> str:
+        return "mqtt" if self.link is not None else "rest"
+
+    # ---------------- setpoint (kiểm tra khoảng trước khi gửi, cả 2 đường) ----------------
+    def set_cutoff_voltage(self, device_id: str, value: float) -> bool:
+        v = _check("cutoff_voltage", value)
+        return self.send(device_id, "cutoff_voltage", {"cutoff_voltage": v}, {"cutoff_voltage": v},
+                         lambda: self.api.set_cutoff_voltage(device_id, v))
+
+    def set_max_power(self, device_id: str, value: float) -> bool:
+        v = _check("max_power", value)
+        return self.send(device_id, "max_power_limit", {"max_power_limit": v}, {"max_power_limit": v},
+                         lambda: self.api.set_max_power(device_id, v))
+
+    def set_schedule(self, device_id: str, idx: int, start: str, end: str,
+                     cutoff_voltage: float, max_power: float) -> bool:
+        if idx not in (1, 2, 3) or not _HHMM.match(str(start)) or not _HHMM.match(str(end)):
+            raise ValueError(f"schedule{idx}: {start!r}-{end!r} không hợp lệ")
+        cv, mw = _check("cutoff_voltage", cutoff_voltage), _check("max_power", max_power)
+        sched = {"index": idx, "start": start, "end": end, "cutoff_voltage": cv, "max_power": mw}
+        expect = {f"schedule{idx}_start": start, f"schedule{idx}_end": end,
+                  f"schedule{idx}_cutoff_voltage": cv, f"schedule{idx}_max_power": mw}
+        return self.send(device_id, f"schedule{idx}", {"schedule": sched}, expect,
+                         lambda: self.api.set_schedule(device_id, idx, start, end, cv, mw))
+
+    # ---------------- gửi ----------------
+    def send(self, device_id: str, key: str, command: Dict[str, Any], expect: Dict[str, Any],
+             rest: Callable[[], bool]) -> bool:
+        """command: body gửi thiết bị; expect: trường telemetry phải echo; rest: đường dự phòng."""
+        t0 = time.perf_counter()
+        via, ok = "rest", False
+        try:
+            if self.link is not None and self.link.connected() and _SAFE_DID.match(device_id):
+                ok = self._send_mqtt(device_id, command, expect)
+                via = "mqtt" if ok else "mqtt>rest"
+            if not ok:
+                with self.api.priority(PRIO_COMMAND), span("command_rest", device=device_id):
+                    ok = bool(rest())
+            return ok
+        finally:
+            self._record(device_id, key, via, ok, time.perf_counter() - t0)
+
+    def _send_mqtt(self, device_id: str, command: Dict[str, Any], expect: Dict[str, Any]) -> bool:
+        p = _Pending(device_id, uuid.uuid4().hex[:12], expect)
+        with self._lock:
+            self._pending[p.cid] = p
+        try:
+            with span("command_mqtt", device=device_id):
+                body = json.dumps({"cmd_id": p.cid, "ts": int(time.time()), **command})
+                if not self.link.publish(self.topic.replace("{device_id}", device_id), body):
+                    return False
+                return p.event.wait(self.timeout)
+        finally:
+            with self._lock:
+                self._pending.pop(p.cid, None)
+
+    def _on_telemetry(self, device_id: str, payload: Dict[str, Any]) -> None:
+        # network thread của paho: chỉ so khớp rồi set event
+        if not self._pending:
+            return
+        with self._lock:
+            waiting = [p for p in self._pending.values() if p.device_id == device_id]
+        if not waiting:
+            return
+        raw = payload.get("raw")
+        if isinstance(raw, dict):
+            payload = {**raw, **payload}
+        for p in waiting:
+            if payload.get("cmd_id") == p.cid or _matches(p.expect, payload):
+                p.event.set()
+
+    # ---------------- độ trễ ----------------
+    def _record(self, device_id: str, key: str, via: str, ok: bool, dt: float) -> None:
+        res = {"ts": time.time(), "device": device_id, "key": key, "via": via, "ok": ok,
+               "latency_ms": round(dt * 1000.0, 1)}
+        print(f"[cmd] {device_id} {key} via {via} {'ok' if ok else 'FAILED'} {res['latency_ms']} ms")
+        with self._lock:
+            self.results.append(res)
+            data = list(self.results)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+        if self.on_result is not None:
+            try:
+                self.on_result(device_id, res)
+            except Exception as e:
+                print("[cmd] result publish error:", e)
+
+
+def _pct(xs: List[float], q: float) -> float:
+    return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Theo đường gửi (mqtt / mqtt>rest / rest): số lệnh, số ok, p50 / p95 / max độ trễ (ms)."""
+    out: Dict[str, Dict[str, Any]] = {}
+    for via in sorted({r.get("via") for r in results}):
+        lat = sorted(r["latency_ms"] for r in results if r.get("via") == via)
+        out[via] = {"count": len(lat), "ok": sum(1 for r in results if r.get("via") == via and r.get("ok")),
+                    "p50_ms": _pct(lat, 0.5), "p95_ms": _pct(lat, 0.95), "max_ms": lat[-1]}
+    return out
+
+
+def recent_commands(path: str = TRACE_DIR, limit: int = 100) -> List[Dict[str, Any]]:
+    """Gộp ring buffer của mọi coordinator/shard (đọc được cả khi run_mode split), mới nhất trước."""
+    out: List[Dict[str, Any]] = []
+    try:
+        names = [n for n in os.listdir(path) if n.startswith("commands-") and n.endswith(".json")]
+    except OSError:
+        return out
+    for n in names:
+        try:
+            with open(os.path.join(path, n), "r", encoding="utf-8") as f:
+                out.extend(json.load(f))
+        except (OSError, ValueError):
+            continue
+    out.sort(key=lambda r: r.get("ts", 0), reverse=True)
+    return out[:limit]
@@ -1,82 +1,217 @@
-import json, time, threading
-from typing import Dict, List
+import time
+from typing import Dict, List, Optional, Tuple
 from paho.mqtt.client import Client
-from mapping import GTI_SENSORS, GRID_SENSORS, TIEUTHU_SENSORS, DAILY_KEYS, MONTHLY_KEYS
-from mqtt_discovery import publish_sensor, publish_binary_sensor, publish_number, publish_datetime
+from anomaly_detector import AnomalyDetector
+from device_registry import shard_of
+from commands import CommandRouter
+from rate_limiter import RateLimited, PRIO_COMMAND
+from sinks import HaMqttSink, UiSink
+from sources import DEVICE_STATE_TOPIC, DeviceMqttSource, decode_payload, make_source
+from profiler import SlowCycleLog, span
+from state_record import DeviceState, Layout, INSTANT_FIELDS, PERIOD_FIELDS
 
-def fmt2(x):
-    try: return round(float(x), 2)
-    except: return 0.00
+SCHEDULE_TTL = 60  # giây, lịch hiện tại (get_schedules) dùng để gộp lệnh sửa 1 trường
+SCHEDULE_FIELDS = ("start", "end", "cutoff_voltage", "max_power")
 
 class Coordinator:
-    def __init__(self, mqtt_client: Client, disc_prefix: str, options: Dict, api_client):
-        self.client = mqtt_client
-        self.prefix = disc_prefix
+    """
+    Hợp nhất dữ liệu từ nguồn (REST / MQTT thiết bị, xem sources.py) rồi đẩy ra các sink
+    (UI + broker HA, xem sinks.py).
+    - tức thời: từ source
+    - daily/monthly: từ server (nếu bật)
+    """
+
+    def __init__(self, mqtt_client: Client, disc_prefix: str, options: Dict, api_client, registry=None,
+                 shard: Tuple[int, int] = (0, 1)):
         self.opt = options
         self.api = api_client
+        self.registry = registry
+        self.shard = shard
         self.scan_interval = int(options.get("scan_interval", 30))
         self.publish_mqtt = bool(options.get("publish_mqtt", True))
         self.use_server_daily_monthly = bool(options.get("use_server_daily_monthly", True))
         self.expose_totals_only = bool(options.get("expose_totals_only", False))
         self.server_enabled = bool(options.get("server_enabled", True))
         self.include_devices = options.get("include_devices", ["all"])
-        self.state_cache: Dict[str, Dict] = {}
-
-    def _device_info(self, device_id: str):
-        return {
-            "identifiers": [f"gti:{device_id}"],
-            "name": device_id,
-            "manufacturer": "GTI",
-            "model": "GTI Control"
-        }
-
-    def discover_entities(self, device_id: str):
-        if not self.publish_mqtt:
+        self.detector = AnomalyDetector()
+        self.source = make_source(options, api_client)
+        self.ui = UiSink()
+        self.ha = HaMqttSink(mqtt_client, disc_prefix,
+                             replay_rate=float(options.get("replay_rate", 20)),
+                             replay_collapse=bool(options.get("replay_collapse", True))) \
+            if (mqtt_client is not None and self.publish_mqtt) else None
+        self.sinks = [s for s in (self.ha, self.ui) if s is not None]
+        # state có kiểu theo device; thứ tự trường cố định theo mapping.py
+        self.with_period = self.use_server_daily_monthly and not self.expose_totals_only
+        self.layout = Layout(INSTANT_FIELDS + (PERIOD_FIELDS if self.with_period else ()))
+        self.records: Dict[str, DeviceState] = {}
+        self.schedules: Dict[str, Tuple[float, Dict]] = {}  # device -> (ts, get_schedules())
+        self.thread = None    # thread chạy loop() (poller.start_coordinator)
+        self.backfill = None  # Backfill: bù long-term statistics HA cho khoảng gián đoạn
+        # vòng poll vượt ngưỡng -> giữ span trace (xem /debug/slow_cycles)
+        self.cycles = SlowCycleLog(f"shard{shard[0]}", threshold_ms=float(options.get("slow_cycle_ms", 10000)),
+                                   keep=int(options.get("slow_cycle_keep", 20)))
+        # lệnh setpoint: REST (mặc định); command_transport "auto" thì thử broker thiết bị trước,
+        # luôn qua TLS (device_mqtt_command_tls, mặc định bật): dùng chung kết nối với source mqtt
+        # nếu cùng chế độ TLS, không thì mở kết nối riêng
+        link = None
+        if options.get("command_transport", "rest") == "auto" and options.get("device_mqtt_host"):
+            tls = bool(options.get("device_mqtt_command_tls", True))
+            link = self.source if isinstance(self.source, DeviceMqttSource) and self.source.tls == tls else \
+                DeviceMqttSource(options, topic=options.get("device_mqtt_state_topic") or DEVICE_STATE_TOPIC, tls=tls)
+        self.commands = CommandRouter(api_client, options, link, name=f"shard{shard[0]}",
+                                      on_result=self.ha.publish_command_result if self.ha is not None else None)
+
+    # UI (server.py) đọc state qua các thuộc tính này, giống StateStore
+    @property
+    def state_cache(self) -> Dict[str, Dict]:
+        return self.ui.state_cache
+
+    @property
+    def versions(self) -> Dict[str, int]:
+        return self.ui.versions
+
+    @property
+    def analytics(self):
+        return self.ui.analytics
+
+    def publish_fleet(self):
+        # chỉ khi coordinator này thấy cả fleet (không chia shard)
+        if not self.analytics or self.shard[1] != 1 or self.ha is None:
             return
-        info = self._device_info(device_id)
-        alls = {}; alls.update(GTI_SENSORS); alls.update(GRID_SENSORS); alls.update(TIEUTHU_SENSORS)
-        for k, meta in alls.items():
-            publish_sensor(self.client, self.prefix, device_id, k, meta, info)
-        publish_binary_sensor(self.client, self.prefix, device_id, info)
-        publish_number(self.client, self.prefix, device_id, "cutoff_voltage", "Điện áp ngắt", "V", 0, 100, 0.1, info)
-        publish_number(self.client, self.prefix, device_id, "max_power_limit", "Công suất giới hạn", "W", 0, 5000, 10, info)
-        for i in [1,2,3]:
-            publish_datetime(self.client, self.prefix, device_id, f"schedule{i}_start", f"Lịch {i} - Bắt đầu", info)
-            publish_datetime(self.client, self.prefix, device_id, f"schedule{i}_end",   f"Lịch {i} - Kết thúc", info)
-            publish_number(self.client, self.prefix, device_id, f"schedule{i}_cutoff_voltage", f"Lịch {i} - Điện áp ngắt", "V", 0, 100, 0.1, info)
-            publish_number(self.client, self.prefix, device_id, f"schedule{i}_max_power", f"Lịch {i} - Công suất", "W", 0, 5000, 10, info)
-
-    def read_device_state(self, device_id: str) -> Dict:
-        # TODO: Kết nối trực tiếp MQTT của thiết bị nếu cần (hiện để trống)
-        return {}
-
-    def build_state(self, device_id: str) -> Dict:
-        st = self.read_device_state(device_id)
-        for k in {**GTI_SENSORS, **GRID_SENSORS, **TIEUTHU_SENSORS}.keys():
-            st[k] = fmt2(st.get(k, 0.0))
-        st["online"] = bool(st.get("online", True))
-
-        if self.server_enabled and self.use_server_daily_monthly and not self.expose_totals_only:
+        self.ha.publish_fleet(self.analytics.mqtt_state())
+
+    def record(self, device_id: str) -> DeviceState:
+        rec = self.records.get(device_id)
+        if rec is None:
+            rec = self.records[device_id] = DeviceState(device_id, self.layout)
+        return rec
+
+    def build_state(self, device_id: str) -> Optional[DeviceState]:
+        """Trả None nếu server không có bản ghi mới (giữ nguyên state đã publish)."""
+        rec = self.record(device_id)
+        srv = None
+        if self.server_enabled and (self.source.name == "rest" or self.with_period):
             srv = self.api.read_state_server(device_id) or {}
-            for dk in DAILY_KEYS:   st[dk] = fmt2(srv.get(dk, st.get(dk, 0.0)))
-            for mk in MONTHLY_KEYS: st[mk] = fmt2(srv.get(mk, st.get(mk, 0.0)))
-        return st
+            if srv.get("changed") is False and self.source.name == "rest" and rec.online:
+                return None
 
-    def publish_state(self, device_id: str, st: Dict):
-        topic = f"gti/{device_id}/state"
-        self.client.publish(topic, json.dumps(st), retain=True)
-        self.state_cache[device_id] = st
+        src = self.source.read(device_id, srv)
+        with span("decode"):
+            now = time.time()
+            rec.update(src, INSTANT_FIELDS, now)
+            if self.with_period:
+                # daily/monthly lấy từ bản ghi server (source REST đã decode chính bản ghi đó)
+                period = src if (self.source.name == "rest" or not srv) else decode_payload(srv)
+                rec.update(period, PERIOD_FIELDS, now)
+            rec.online = src.get("online", True) is not False
+        return rec
+
+    def publish_state(self, device_id: str, rec: DeviceState):
+        # mẫu mới (không phải state cũ đánh offline) -> cập nhật detector, gộp cờ vào payload
+        st = rec.snapshot()
+        if rec.online:
+            with span("detector"):
+                rec.flags = self.detector.update(device_id, st)
+            st.update(rec.flags)
+        payload = rec.to_json()
+        for sink in self.sinks:
+            with span("publish", sink=type(sink).__name__):
+                sink.publish_state(device_id, st, payload)
+
+    # ---------------- lệnh từ HA (number / datetime) ----------------
+    def _current_schedule(self, device_id: str, idx: int) -> Optional[Dict]:
+        """Lịch idx đang có trên server (cache SCHEDULE_TTL); None nếu không đọc được đủ 4 trường."""
+        hit = self.schedules.get(device_id)
+        if hit is None or time.time() - hit[0] >= SCHEDULE_TTL:
+            with self.api.priority(PRIO_COMMAND):
+                data = self.api.get_schedules(device_id) or {}
+            if not data:
+                return None
+            hit = self.schedules[device_id] = (time.time(), data)
+        cur = hit[1].get(f"schedule{idx}")
+        if not isinstance(cur, dict) or any(cur.get(f) is None for f in SCHEDULE_FIELDS):
+            return None
+        return {f: cur[f] for f in SCHEDULE_FIELDS}
+
+    def handle_command(self, device_id: str, kind: str, key: str, payload: str) -> bool:
+        if self.registry:
+            device_id = self.registry.resolve(device_id) or device_id
+        # run_mode split: mọi shard đều subscribe gti/+/cmd/... -> chỉ shard sở hữu device thực hiện
+        if shard_of(device_id, self.shard[1]) != self.shard[0]:
+            return False
+        try:
+            # CommandRouter: MQTT thiết bị -> REST (PRIO_COMMAND) nếu không thấy echo
+            if kind == "number" and key == "cutoff_voltage":
+                return self.commands.set_cutoff_voltage(device_id, float(payload))
+            if kind == "number" and key == "max_power_limit":
+                return self.commands.set_max_power(device_id, float(payload))
+            if key.startswith("schedule") and "_" in key:
+                idx, field = key[len("schedule"):].split("_", 1)
+                idx = int(idx)
+                # entity HA chỉ gửi 1 trường: 3 trường còn lại lấy từ lịch trên server,
+                # không biết lịch hiện tại thì từ chối (không đẩy 00:00 / 0 W xuống inverter)
+                cur = self._current_schedule(device_id, idx)
+                if cur is None:
+                    raise ValueError(f"schedule{idx}: chưa đọc được lịch hiện tại")
+                if kind == "datetime":
+                    # HA gửi ISO datetime -> lịch chỉ dùng HH:MM
+                    cur[field] = payload.replace("T", " ").split(" ")[-1][:5]
+                else:
+                    cur[field] = float(payload)
+                ok = self.commands.set_schedule(device_id, idx, cur["start"], cur["end"],
+                                                float(cur["cutoff_voltage"]), float(cur["max_power"]))
+                if ok:
+                    self.schedules[device_id][1][f"schedule{idx}"] = cur
+                return ok
+        except (ValueError, RateLimited) as e:
+            print("[coord] command", device_id, key, "failed:", e)
+        return False
+
+    def my_devices(self, device_ids: List[str]) -> List[str]:
+        i, n = self.shard
+        return [d for d in device_ids if shard_of(d, n) == i]
 
     def loop(self, device_ids: List[str]):
-        for d in device_ids:
-            self.discover_entities(d)
+        self.source.start()
+        if self.commands.link is not None:
+            self.commands.link.start()  # no-op nếu chính là source đã start
+        if self.ha is not None:
+            self.ha.fleet = bool(self.analytics) and self.shard[1] == 1
+            self.ha.attach(self.handle_command)
         while True:
-            for d in device_ids:
+            # registry đối soát nền -> lấy danh sách mới mỗi vòng (tra cứu local)
+            if self.registry:
+                self.registry.refresh()
+            ids = self.my_devices((self.registry.selected() if self.registry else None) or device_ids)
+            for link in (self.source, self.commands.link):
+                if isinstance(link, DeviceMqttSource):
+                    link.set_devices(ids)  # chỉ topic của device shard này; cùng object lần 2 là no-op
+            with self.cycles.cycle(devices=len(ids)):
+                self._cycle(ids)
+            time.sleep(self.scan_interval)
+
+    def _cycle(self, ids: List[str]):
+        if self.ha is not None:
+            for d in ids:
+                if not self.ha.discovered(d):
+                    with span("discovery", device=d):
+                        self.ha.discover(d)
+        for d in ids:
+            with span("device", device=d):
                 try:
                     st = self.build_state(d)
-                    self.publish_state(d, st)
+                    if st is not None:
+                        self.publish_state(d, st)
+                except RateLimited:
+                    # nhường ngân sách cho UI/lệnh: bỏ qua device này ở vòng này, giữ state cũ
+                    continue
                 except Exception:
-                    st = self.state_cache.get(d, {}) or {}
-                    st["online"] = False
-                    self.publish_state(d, st)
-            time.sleep(self.scan_interval)
+                    rec = self.record(d)
+                    rec.online = False
+                    self.publish_state(d, rec)
+        try:
+            with span("fleet"):
+                self.publish_fleet()
+        except Exception as e:
+            print("[coord] fleet publish error:", e)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Thống kê toàn bộ fleet trên dữ liệu đã cache (NumPy, dạng cột).
+- latest[i, f]: giá trị mới nhất của device i, trường f
+- hist[i, k, f]: ring buffer HISTORY mẫu gần nhất của từng device
+Tổng hợp (tổng PV, lấy lưới, tỉ lệ tự dùng), xếp hạng hiệu suất
+power / (voltage_dc * current) và cờ bất thường đều tính bằng phép toán vector,
+không lặp Python theo từng device.
+"""
+
+from __future__ import annotations
+
+import threading, time
+from typing import Any, Dict, List
+
+try:
+    import numpy as np
+except ImportError:  # armv7/i386 có thể không có wheel numpy
+    np = None
+
+FIELDS = ("power", "voltage_dc", "current", "mosfet_temp", "grid_power", "tieuthu_power")
+F = {k: i for i, k in enumerate(FIELDS)}
+
+HISTORY = 60            # số mẫu giữ lại / device
+TEMP_Z = 3.5            # ngưỡng robust z-score (median/MAD) cho nhiệt độ Mosfet
+TEMP_MAD_MIN = 1.0      # °C, chặn dưới MAD khi fleet gần như cùng nhiệt độ
+DAYLIGHT_W = 50.0       # median công suất fleet > ngưỡng này coi như đang có nắng
+STUCK_W = 1.0           # max công suất gần đây < ngưỡng -> kẹt ở 0
+
+
+def available() -> bool:
+    return np is not None
+
+
+class FleetAnalytics:
+    def __init__(self, capacity: int = 16, history: int = HISTORY) -> None:
+        self._lock = threading.Lock()
+        self.index: Dict[str, int] = {}
+        self.devices: List[str] = []
+        self.history = history
+        self.latest = np.zeros((capacity, len(FIELDS)))
+        self.hist = np.full((capacity, history, len(FIELDS)), np.nan)
+        self.pos = np.zeros(capacity, dtype=np.int64)
+        self.ts = np.zeros(capacity)
+        self.online = np.zeros(capacity, dtype=bool)
+
+    def _row(self, device_id: str) -> int:
+        i = self.index.get(device_id)
+        if i is not None:
+            return i
+        i = len(self.devices)
+        if i >= self.latest.shape[0]:
+            grow = self.latest.shape[0]
+            self.latest = np.vstack([self.latest, np.zeros((grow, len(FIELDS)))])
+            self.hist = np.concatenate([self.hist, np.full((grow, self.history, len(FIELDS)), np.nan)])
+            self.pos = np.concatenate([self.pos, np.zeros(grow, dtype=np.int64)])
+            self.ts = np.concatenate([self.ts, np.zeros(grow)])
+            self.online = np.concatenate([self.online, np.zeros(grow, dtype=bool)])
+        self.index[device_id] = i
+        self.devices.append(device_id)
+        return i
+
+    def update(self, device_id: str, st: Dict[str, Any]) -> None:
+        row = []
+        for k in FIELDS:
+            try:
+                row.append(float(st.get(k, 0.0)))
+            except (TypeError, ValueError):
+                row.append(0.0)
+        with self._lock:
+            i = self._row(device_id)
+            self.latest[i] = row
+            self.hist[i, self.pos[i] % self.history] = row
+            self.pos[i] += 1
+            self.ts[i] = time.time()
+            self.online[i] = bool(st.get("online", True))
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            n = len(self.devices)
+            names = list(self.devices)
+            cur = self.latest[:n].copy()
+            hist = self.hist[:n].copy()
+            online = self.online[:n].copy()
+            ts = self.ts[:n].copy()
+        if n == 0:
+            return {"devices": 0, "online": 0, "total_pv_power": 0.0, "grid_import_power": 0.0, "consumption_power": 0.0,
+                    "self_consumption_ratio": 0.0, "efficiency_ranking": [], "anomalies": {}, "anomaly_count": 0}
+
+        cur = np.where(online[:, None], cur, 0.0)
+        power, vdc, amp = cur[:, F["power"]], cur[:, F["voltage_dc"]], cur[:, F["current"]]
+        total_pv = float(power.sum())
+        grid_import = float(np.clip(cur[:, F["grid_power"]], 0, None).sum())
+        consumption = float(cur[:, F["tieuthu_power"]].sum())
+        # phần PV dùng tại chỗ = tiêu thụ - lấy lưới, chia cho tổng PV
+        self_cons = float(np.clip((consumption - grid_import) / total_pv, 0.0, 1.0)) if total_pv > 0 else 0.0
+
+        dc = vdc * amp
+        eff = np.divide(power, dc, out=np.full(n, np.nan), where=dc > 0)
+        order = np.argsort(np.where(np.isnan(eff), -np.inf, eff))[::-1]
+        ranking = [{"device_id": names[i], "efficiency": round(float(eff[i]), 4)}
+                   for i in order if not np.isnan(eff[i])]
+
+        # nhiệt độ Mosfet lệch khỏi fleet (robust z-score)
+        temp = cur[:, F["mosfet_temp"]]
+        med = np.median(temp[online]) if online.any() else 0.0
+        mad = np.median(np.abs(temp[online] - med)) if online.any() else 0.0
+        z = 0.6745 * (temp - med) / max(float(mad), TEMP_MAD_MIN)
+        temp_outlier = online & (z > TEMP_Z)
+
+        # kẹt ở 0 khi fleet đang phát (proxy ban ngày)
+        daylight = online.any() and float(np.median(power[online])) > DAYLIGHT_W
+        recent_max = np.nanmax(np.nan_to_num(hist[:, :, F["power"]], nan=0.0), axis=1)
+        stuck_zero = online & (recent_max < STUCK_W) & daylight
+
+        anomalies: Dict[str, List[str]] = {}
+        for i in np.flatnonzero(temp_outlier | stuck_zero):
+            flags = []
+            if temp_outlier[i]:
+                flags.append("mosfet_temp_outlier")
+            if stuck_zero[i]:
+                flags.append("stuck_zero_daylight")
+            anomalies[names[i]] = flags
+
+        return {
+            "devices": n,
+            "online": int(online.sum()),
+            "total_pv_power": round(total_pv, 2),
+            "grid_import_power": round(grid_import, 2),
+            "consumption_power": round(consumption, 2),
+            "self_consumption_ratio": round(self_cons, 4),
+            "efficiency_ranking": ranking,
+            "anomalies": anomalies,
+            "anomaly_count": len(anomalies),
+            "oldest_sample_age": round(float(time.time() - ts.min()), 1),
+        }
+
+    def mqtt_state(self) -> Dict[str, Any]:
+        s = self.summary()
+        return {k: s[k] for k in ("devices", "total_pv_power", "grid_import_power", "consumption_power",
+                                  "self_consumption_ratio", "anomaly_count")}
@@ -13,11 +13,12 @@ def publish_sensor(client: Client, prefix: str, device_id: str, key: str, meta:
     payload = {
         "name": meta[0],
         "state_topic": f"gti/{device_id}/state",
-        "unit_of_measurement": meta[1],
         "value_template": f"{{{{ value_json.{key} | default(0.0) }}}}",
         "unique_id": object_id,
         "device": device_info
     }
+    if meta[1]:
+        payload["unit_of_measurement"] = meta[1]
     if meta[2]:
         payload["device_class"] = meta[2]
     if meta[3]:
@@ -37,6 +38,20 @@ def publish_binary_sensor(client: Client, prefix: str, device_id: str, device_in
     }
     client.publish(disc_topic(prefix, "binary_sensor", object_id), json.dumps(payload), retain=True)
 
+def publish_alert(client: Client, prefix: str, device_id: str, key: str, name: str, device_info: Dict[str, Any]):
+    object_id = obj_id(device_id, key)
+    payload = {
+        "name": name,
+        "state_topic": f"gti/{device_id}/state",
+        "value_template": f"{{{{ 'ON' if value_json.{key} | default(false) else 'OFF' }}}}",
+        "payload_on": "ON",
+        "payload_off": "OFF",
+        "device_class": "problem",
+        "unique_id": object_id,
+        "device": device_info
+    }
+    client.publish(disc_topic(prefix, "binary_sensor", object_id), json.dumps(payload), retain=True)
+
 def publish_number(client: Client, prefix: str, device_id: str, key: str, name: str, unit: str, minv: float, maxv: float, step: float, device_info: Dict[str, Any]):
     object_id = obj_id(device_id, key)
     payload = {
@@ -62,3 +77,20 @@ def publish_datetime(client: Client, prefix: str, device_id: str, key: str, name
         "device": device_info
     }
     client.publish(disc_topic(prefix, "datetime", object_id), json.dumps(payload), retain=True)
+
+def publish_command_latency(client: Client, prefix: str, device_id: str, device_info: Dict[str, Any]):
+    # gti/<device>/cmd/result do CommandRouter gửi sau mỗi lệnh; via/ok/key làm attributes
+    object_id = obj_id(device_id, "command_latency")
+    payload = {
+        "name": "Độ trễ lệnh",
+        "state_topic": f"gti/{device_id}/cmd/result",
+        "value_template": "{{ value_json.latency_ms }}",
+        "json_attributes_topic": f"gti/{device_id}/cmd/result",
+        "unit_of_measurement": "ms",
+        "device_class": "duration",
+        "state_class": "measurement",
+        "entity_category": "diagnostic",
+        "unique_id": object_id,
+        "device": device_info
+    }
+    client.publish(disc_topic(prefix, "sensor", object_id), json.dumps(payload), retain=True)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Tiến trình poller tách riêng khỏi web/UI.
+- run_mode "single": server.py tự chạy coordinator trong process uvicorn (mặc định)
+- run_mode "split":  run.sh chạy N poller (mỗi shard 1 process) + uvicorn ở vai trò web;
+  web đọc state từ các topic retained gti/<device>/state
+Mỗi shard giữ 1 lockfile ở /data/locks -> đúng 1 coordinator / shard,
+kể cả khi uvicorn chạy --workers N.
+"""
+
+from __future__ import annotations
+
+import argparse, fcntl, json, os, sys, threading
+from typing import Any, Dict, Optional
+
+from paho.mqtt.client import Client
+
+from api_client import APIClient
+from coordinator import Coordinator
+from device_registry import DeviceRegistry
+from offline_buffer import OfflineBuffer
+from history_store import HistoryStore
+import backfill
+import fleet_analytics
+
+ADDON_OPTIONS_PATH = "/data/options.json"
+LOCK_DIR = "/data/locks"
+
+
+def load_options() -> Dict[str, Any]:
+    try:
+        with open(ADDON_OPTIONS_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def acquire_shard_lock(shard: int, shards: int) -> Optional[int]:
+    """flock không chặn; trả fd (giữ suốt đời process) hoặc None nếu shard đã có chủ."""
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    path = os.path.join(LOCK_DIR, f"coordinator-{shard}-of-{shards}.lock")
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    return fd
+
+
+def connect_mqtt(opt: Dict[str, Any], client_id: str) -> Optional[Client]:
+    mqtt_host = opt.get("mqtt_host") or os.getenv("MQTT_HOST") or "core-mosquitto"
+    mqtt_port = int(opt.get("mqtt_port", 1883))
+    mqtt_user = opt.get("mqtt_username") or os.getenv("MQTT_USERNAME")
+    mqtt_pass = opt.get("mqtt_password") or os.getenv("MQTT_PASSWORD")
+
+    client = None
+    try:
+        client = Client(client_id=client_id)
+        if mqtt_user:
+            client.username_pw_set(mqtt_user, mqtt_pass)
+        # kết nối trong network thread của paho: tự reconnect khi broker mất/khởi động lại
+        client.reconnect_delay_set(min_delay=1, max_delay=60)
+        client.connect_async(mqtt_host, mqtt_port, keepalive=60)
+        client.loop_start()
+    except Exception as e:
+        print("[gti] MQTT connect failed:", e)
+    return client
+
+
+def start_coordinator(opt: Dict[str, Any], mqtt_client: Client, api_client: APIClient,
+                      registry: DeviceRegistry, shard: int = 0, shards: int = 1) -> Coordinator:
+    dids = registry.selected()
+    coordinator = Coordinator(mqtt_client, opt.get("mqtt_prefix","homeassistant"), opt, api_client, registry,
+                              shard=(shard, shards))
+    if fleet_analytics.available():
+        coordinator.ui.analytics = fleet_analytics.FleetAnalytics()
+    coordinator.ui.history = HistoryStore(retention_days=int(opt.get("history_days", 90)))
+    if coordinator.ha is not None:
+        try:
+            coordinator.ha.buffer = OfflineBuffer(f"/data/mqtt_buffer/{shard}",
+                                                  max_bytes=int(opt.get("offline_buffer_mb", 8)) * 1024 * 1024)
+        except OSError as e:
+            print("[gti] offline buffer disabled:", e)
+    if opt.get("backfill_enabled", True) and opt.get("server_enabled", True):
+        if backfill.available():
+            coordinator.backfill = backfill.Backfill(api_client, coordinator.ui.history, opt, shard=shard)
+            coordinator.backfill.start(lambda: coordinator.my_devices(registry.selected()))
+        else:
+            print("[gti] statistics backfill disabled (needs homeassistant_api and websocket-client)")
+    t = threading.Thread(target=coordinator.loop, args=(dids,), name=f"coordinator-{shard}", daemon=True)
+    t.start()
+    coordinator.thread = t
+    print(f"[gti] Started coordinator shard {shard}/{shards} with devices:", coordinator.my_devices(dids))
+    return coordinator
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="GTI Control poller")
+    ap.add_argument("--shard", type=int, default=0)
+    ap.add_argument("--shards", type=int, default=1)
+    args = ap.parse_args()
+
+    if acquire_shard_lock(args.shard, args.shards) is None:
+        print(f"[gti] shard {args.shard}/{args.shards} already has a coordinator, exit")
+        return
+
+    opt = load_options()
+    mqtt_client = connect_mqtt(opt, f"gti-control-poller-{args.shard}")
+    api_client = APIClient(opt)
+    api_client.login()
+
+    registry = DeviceRegistry(api_client, opt)
+    # chỉ shard 0 đối soát registry; shard khác đọc lại file khi nó đổi
+    if opt.get("server_enabled", True) and args.shard == 0:
+        registry.start()
+
+    coordinator = start_coordinator(opt, mqtt_client, api_client, registry, args.shard, args.shards)
+    # coordinator là daemon thread: nó chết thì thoát (nhả lock) để run.sh khởi động lại shard
+    coordinator.thread.join()
+    print(f"[gti] coordinator shard {args.shard}/{args.shards} stopped, exit")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
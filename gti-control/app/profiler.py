@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Công cụ chẩn đoán khi chạy thật, không cần bật DEBUG:
+- sample(): sampling profiler toàn process (mọi thread: coordinator, uvicorn, paho...)
+  qua sys._current_frames(), trả "folded stacks" (flamegraph.pl, speedscope, inferno)
+- SlowCycleLog + span(): đo thời gian từng bước trong 1 vòng Coordinator.loop
+  (login, http, decode, publish...); vòng nào vượt ngưỡng thì giữ lại trong ring buffer
+  và ghi ra /data/traces/cycles-<shard>.json để web (kể cả run_mode split) đọc được.
+span() ngoài 1 vòng đang đo (vd. request từ UI) gần như không tốn gì.
+"""
+
+from __future__ import annotations
+
+import json, os, sys, threading, time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+TRACE_DIR = "/data/traces"
+MAX_PROFILE_SECONDS = 120
+MAX_SPANS = 2000  # mỗi vòng; tránh vòng có rất nhiều device phình bộ nhớ
+
+_tl = threading.local()
+_profile_lock = threading.Lock()
+
+
+# ---------------- span trace ----------------
+class _Trace:
+    __slots__ = ("t0", "spans", "depth")
+
+    def __init__(self) -> None:
+        self.t0 = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.depth = 0
+
+
+@contextmanager
+def span(name: str, **meta):
+    tr: Optional[_Trace] = getattr(_tl, "trace", None)
+    if tr is None:
+        yield
+        return
+    t = time.perf_counter()
+    tr.depth += 1
+    try:
+        yield
+    finally:
+        tr.depth -= 1
+        if len(tr.spans) < MAX_SPANS:
+            rec = {"name": name, "depth": tr.depth, "start_ms": round((t - tr.t0) * 1000, 2),
+                   "ms": round((time.perf_counter() - t) * 1000, 2)}
+            if meta:
+                rec.update(meta)
+            tr.spans.append(rec)
+
+
+class SlowCycleLog:
+    def __init__(self, name: str, threshold_ms: float = 10000, keep: int = 20, path: str = TRACE_DIR) -> None:
+        self.name = name
+        self.threshold_ms = threshold_ms
+        self.cycles: deque = deque(maxlen=keep)
+        self.path = path
+        self.count = 0
+
+    @contextmanager
+    def cycle(self, **meta):
+        tr = _tl.trace = _Trace()
+        started = time.time()
+        try:
+            yield
+        finally:
+            _tl.trace = None
+            ms = (time.perf_counter() - tr.t0) * 1000
+            self.count += 1
+            if ms >= self.threshold_ms:
+                tr.spans.sort(key=lambda s: s["start_ms"])
+                self.cycles.append({"source": self.name, "started": round(started, 3), "ms": round(ms, 2),
+                                    "threshold_ms": self.threshold_ms, **meta, "spans": tr.spans})
+                print(f"[trace] slow cycle {ms:.0f} ms ({len(tr.spans)} spans)")
+                self._save()
+
+    def _save(self) -> None:
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp = os.path.join(self.path, f".cycles-{self.name}.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(list(self.cycles), f, ensure_ascii=False)
+            os.replace(tmp, os.path.join(self.path, f"cycles-{self.name}.json"))
+        except OSError as e:
+            print("[trace] save error:", e)
+
+
+def recent_cycles(path: str = TRACE_DIR, limit: int = 50) -> List[Dict[str, Any]]:
+    """Gộp ring buffer của mọi coordinator/shard, mới nhất trước."""
+    out: List[Dict[str, Any]] = []
+    try:
+        names = [n for n in os.listdir(path) if n.startswith("cycles-") and n.endswith(".json")]
+    except OSError:
+        return out
+    for n in names:
+        try:
+            with open(os.path.join(path, n), "r", encoding="utf-8") as f:
+                out.extend(json.load(f))
+        except (OSError, ValueError):
+            continue
+    out.sort(key=lambda c: c.get("started", 0), reverse=True)
+    return out[:limit]
+
+
+# ---------------- sampling profiler ----------------
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample(seconds: float, interval: float = 0.01) -> Optional[str]:
+    """
+    Lấy mẫu stack mọi thread mỗi `interval` giây trong `seconds` giây.
+    Trả folded stacks "thread;f1;f2;... count" hoặc None nếu đang có phiên khác chạy.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    try:
+        seconds = min(max(seconds, 0.1), MAX_PROFILE_SECONDS)
+        interval = max(interval, 0.001)
+        me = threading.get_ident()
+        counts: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        return "".join(f"{k} {v}\n" for k, v in sorted(counts.items()))
+    finally:
+        _profile_lock.release()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Token bucket dùng chung cho mọi request tới server giabao-inverter.
+Thứ tự ưu tiên: lệnh điều khiển > UI > poll nền.
+- Mỗi mức ưu tiên thấp hơn phải chừa lại 1 phần ngân sách (RESERVE) cho mức cao hơn
+- Có request ưu tiên cao đang chờ thì request ưu tiên thấp nhường lượt
+- 429/503 kèm Retry-After -> chặn toàn bộ tới hết thời gian server yêu cầu
+- path: tokens + blocked_until nằm trong file khoá bằng flock (/data/api_budget.json) ->
+  mọi process (poller shard, web worker khi run_mode split) dùng chung 1 ngân sách;
+  UI tiêu token thì poller cũng chạm ngưỡng RESERVE. Hàng chờ theo ưu tiên vẫn tính trong process.
+"""
+
+from __future__ import annotations
+
+import fcntl, json, os, threading, time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+PRIO_COMMAND = 0
+PRIO_UI = 1
+PRIO_POLL = 2
+
+# phần ngân sách (theo burst) phải còn lại sau khi lấy token, theo mức ưu tiên
+RESERVE = {PRIO_COMMAND: 0.0, PRIO_UI: 0.1, PRIO_POLL: 0.3}
+# thời gian chờ tối đa mặc định (giây)
+WAIT = {PRIO_COMMAND: 30.0, PRIO_UI: 10.0, PRIO_POLL: 5.0}
+BUDGET_PATH = "/data/api_budget.json"
+
+
+class RateLimited(Exception):
+    """Hết ngân sách request (hoặc server đang yêu cầu chờ)."""
+
+
+def parse_retry_after(value: Optional[str], default: float = 60.0) -> float:
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return default
+
+
+class RateLimiter:
+    def __init__(self, per_minute: float = 60.0, burst: Optional[float] = None,
+                 path: Optional[str] = None) -> None:
+        self.rate = max(per_minute, 1.0) / 60.0
+        self.capacity = float(burst or max(per_minute / 6.0, 3.0))
+        self.tokens = self.capacity
+        self.blocked_until = 0.0
+        self.path = path
+        self._stamp = time.time()  # wall clock: so được giữa các process
+        self._cond = threading.Condition()
+        self._waiting = {PRIO_COMMAND: 0, PRIO_UI: 0, PRIO_POLL: 0}
+        self._tl = threading.local()
+
+    @contextmanager
+    def _shared(self):
+        """
+        Gọi khi đang giữ self._cond. Có path: flock file, nạp tokens/stamp/blocked_until,
+        ghi lại sau khối with. Không mở được file (dev, /data read-only) -> ngân sách trong process.
+        """
+        fd = None
+        if self.path is not None:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            except OSError:
+                fd = None
+        if fd is None:
+            yield
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                st = json.loads(os.pread(fd, 4096, 0) or b"{}")
+                self.tokens = min(self.capacity, float(st["tokens"]))
+                self._stamp = float(st["stamp"])
+                self.blocked_until = max(self.blocked_until, float(st.get("blocked_until", 0.0)))
+            except (ValueError, KeyError, TypeError):
+                pass  # file mới / ghi dở: bắt đầu từ trạng thái của process này
+            yield
+            data = json.dumps({"tokens": self.tokens, "stamp": self._stamp,
+                               "blocked_until": self.blocked_until}).encode()
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, data, 0)
+        finally:
+            os.close(fd)  # nhả flock
+
+    def _refill(self) -> None:
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def _higher_waiting(self, prio: int) -> bool:
+        return any(n > 0 for p, n in self._waiting.items() if p < prio)
+
+    def acquire(self, prio: int = PRIO_POLL, timeout: Optional[float] = None) -> bool:
+        deadline = time.monotonic() + (WAIT[prio] if timeout is None else timeout)
+        with self._cond:
+            self._waiting[prio] += 1
+            try:
+                while True:
+                    with self._shared():
+                        self._refill()
+                        blocked = self.blocked_until - time.time()
+                        floor = 1.0 + RESERVE[prio] * self.capacity
+                        ok = blocked <= 0 and self.tokens >= floor and not self._higher_waiting(prio)
+                        if ok:
+                            self.tokens -= 1.0
+                    if ok:
+                        return True
+                    now = time.monotonic()
+                    if now >= deadline:
+                        return False
+                    need = max(blocked, (floor - self.tokens) / self.rate, 0.05)
+                    self._cond.wait(min(need, deadline - now))
+            finally:
+                self._waiting[prio] -= 1
+                self._cond.notify_all()
+
+    def penalize(self, retry_after: float) -> None:
+        """Server trả 429/503: dừng mọi request tới hết Retry-After."""
+        with self._cond, self._shared():
+            self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+            self.tokens = 0.0
+            self._cond.notify_all()
+
+    # ---------------- ưu tiên theo thread ----------------
+    @property
+    def current(self) -> int:
+        return getattr(self._tl, "prio", PRIO_POLL)
+
+    @contextmanager
+    def priority(self, prio: int):
+        """Đánh dấu mọi request trong khối with thuộc mức ưu tiên `prio`."""
+        prev = getattr(self._tl, "prio", None)
+        self._tl.prio = prio
+        try:
+            yield
+        finally:
+            if prev is None:
+                del self._tl.prio
+            else:
+                self._tl.prio = prev
+
+    def snapshot(self) -> dict:
+        with self._cond, self._shared():
+            self._refill()
+            return {
+                "tokens": round(self.tokens, 2),
+                "capacity": self.capacity,
+                "per_minute": round(self.rate * 60.0, 2),
+                "blocked_for": round(max(0.0, self.blocked_until - time.time()), 1),
+                "waiting": dict(self._waiting),
+            }
@@ -1,16 +1,39 @@
-import os, json, threading, time
-from typing import Dict, List
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+import os, json, math, threading, time
+from datetime import datetime, timezone
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from fastapi import FastAPI, Query, Request, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from starlette.concurrency import run_in_threadpool
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
 from paho.mqtt.client import Client
 
 from api_client import APIClient
 from coordinator import Coordinator
+from device_registry import DeviceRegistry, normalize_did
+from poller import acquire_shard_lock, connect_mqtt, start_coordinator
+from state_store import StateStore
+from view_models import ViewCache
+from rate_limiter import RateLimited, PRIO_COMMAND, PRIO_UI
+from dateutil.parser import isoparse
+import commands
+import history_store
+import profiler
 
 ADDON_OPTIONS_PATH = "/data/options.json"
 
+# "debug": add-on gti-control-debug (mở port 8099, không qua ingress/auth của HA):
+# chỉ phục vụ các route đọc trong DEBUG_PATHS (bật thêm /api/which, /api/devices, /api/state, /api/fields);
+# UI, login (ghi options.json), lệnh setpoint, export, /debug/* chỉ có ở bản ingress
+VARIANT = os.getenv("GTI_VARIANT", "ingress")
+# "all": process này vừa phục vụ UI vừa cố chạy coordinator (nếu giành được lock)
+# "web": chỉ UI, state đọc từ MQTT retained (run_mode "split" trong run.sh)
+# bản debug luôn là "web": không poll / subscribe lệnh / backfill song song với add-on chính
+ROLE = "web" if VARIANT == "debug" else os.getenv("GTI_ROLE", "all")
+DEBUG_PATHS = frozenset(("/health", "/ready", "/api/which", "/api/devices", "/api/state", "/api/fields",
+                         "/api/fleet/summary"))
+
 def load_options() -> Dict:
     try:
         with open(ADDON_OPTIONS_PATH, "r", encoding="utf-8") as f:
@@ -18,61 +41,305 @@ def load_options() -> Dict:
     except Exception:
         return {}
 
-env = Environment(loader=FileSystemLoader("/app/templates"), autoescape=select_autoescape(['html','xml']))
+JINJA_CACHE_DIR = "/data/jinja_cache"
+SCHEDULES_TTL = 60      # giây, cache lịch đọc từ server
+RENDER_CACHE_SIZE = 256 # số trang đã render giữ lại
+
+def _make_env() -> Environment:
+    kw = {}
+    try:
+        os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+        kw["bytecode_cache"] = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+    except OSError:
+        pass
+    return Environment(loader=FileSystemLoader("/app/templates"), autoescape=select_autoescape(['html','xml']), **kw)
+
+env = _make_env()
+# compile sẵn mọi template lúc khởi động (bytecode lưu ở /data, lần sau chỉ nạp lại)
+templates = {name: env.get_template(name) for name in env.list_templates(extensions=["html"])}
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="/app/static"), name="static")
 
+if VARIANT == "debug":
+    @app.middleware("http")
+    async def _debug_allowlist(req: Request, call_next):
+        if req.url.path not in DEBUG_PATHS:
+            return JSONResponse({"detail": "Not Found"}, status_code=404)
+        return await call_next(req)
+
 mqtt_client: Client = None
 coordinator: Coordinator = None
+state_store: StateStore = None
+# role web: lệnh từ UI cũng qua CommandRouter (kiểm tra khoảng + đo độ trễ), chỉ đường REST
+web_commands: commands.CommandRouter = None
 device_ids: List[str] = []
 api_client: APIClient = None
+registry: DeviceRegistry = None
+options: Dict = {}
+
+# trạng thái khởi động nền: /health = liveness, /ready = readiness
+boot = {"stage": "init", "ready": False, "error": None, "t0": time.time(), "ready_at": None}
 
 @app.get("/health")
 def health():
-    return {"ok": True, "ts": time.time()}
+    return {"ok": True, "ts": time.time(), "role": ROLE, "coordinator": coordinator is not None}
 
-def start_system():
-    global mqtt_client, coordinator, api_client, device_ids
-    opt = load_options()
+@app.get("/ready")
+def ready():
+    body = {"ready": boot["ready"], "stage": boot["stage"], "error": boot["error"], "role": ROLE}
+    if api_client:
+        body["api_budget"] = api_client.limiter.snapshot()
+    if boot["ready_at"]:
+        body["boot_s"] = round(boot["ready_at"] - boot["t0"], 3)
+    return JSONResponse(body, status_code=200 if boot["ready"] else 503)
 
-    mqtt_host = opt.get("mqtt_host") or os.getenv("MQTT_HOST") or "core-mosquitto"
-    mqtt_port = int(opt.get("mqtt_port", 1883))
-    mqtt_user = opt.get("mqtt_username") or os.getenv("MQTT_USERNAME")
-    mqtt_pass = opt.get("mqtt_password") or os.getenv("MQTT_PASSWORD")
+def restore_from_cache():
+    """Chỉ đọc file ở /data (token, registry) -> UI có dữ liệu ngay, không gọi mạng."""
+    global api_client, registry, device_ids, options
+    opt = options = load_options()
+    api_client = APIClient(opt)
+    registry = DeviceRegistry(api_client, opt)
+    device_ids = registry.selected()
+    boot["stage"] = "cache"
 
-    try:
-        mqtt_client = Client(client_id="gti-control-ui")
-        if mqtt_user:
-            mqtt_client.username_pw_set(mqtt_user, mqtt_pass)
-        mqtt_client.connect(mqtt_host, mqtt_port, keepalive=60)
-    except Exception as e:
-        print("[gti] MQTT connect failed:", e)
+_system_lock = threading.Lock()
 
-    api_client = APIClient(opt)
+def start_system(fresh: bool = True):
+    with _system_lock:
+        return _start_system(fresh)
+
+def _start_system(fresh: bool):
+    global mqtt_client, coordinator, state_store, web_commands, api_client, registry, device_ids, options
+    changed = False
+    if api_client is None:
+        restore_from_cache()
+    elif fresh:
+        # login lại từ UI: đổi credentials trên chính các object coordinator / source /
+        # backfill / thread đối soát đang giữ (không tạo client + limiter thứ 2)
+        options = load_options()
+        changed = api_client.reload(options)
+        registry.reload(options, reset=changed)
+    opt = options
+
+    if coordinator is not None or state_store is not None:
+        api_client.login()
+        if coordinator is not None and opt.get("server_enabled", True):
+            registry.start()  # no-op nếu đã chạy
+            if changed:
+                registry.reconcile()
+        return registry.selected()
+
+    lead = ROLE != "web" and acquire_shard_lock(0, 1) is not None
+    boot["stage"] = "mqtt"
+    mqtt_client = connect_mqtt(opt, "gti-control-ui" if lead else f"gti-control-web-{os.getpid()}")
+
+    boot["stage"] = "login"
     api_client.login()
 
-    dids = []
+    if not lead:
+        # worker uvicorn khác / run_mode split: không poll, chỉ đọc state retained
+        state_store = StateStore(mqtt_client)
+        state_store.attach()
+        web_commands = commands.CommandRouter(api_client, {"command_transport": "rest"},
+                                              name=f"web-{os.getpid()}")
+        print("[gti] web role, reading state from MQTT retained topics")
+        return registry.selected()
+
+    boot["stage"] = "devices"
     if opt.get("server_enabled", True):
-        dids = api_client.list_devices()
-    inc = opt.get("include_devices", [])
-    if not dids and inc and inc != ["all"]:
-        dids = inc
-    if not dids:
-        dids = ["gti283"]
+        registry.start()
+    coordinator = start_coordinator(opt, mqtt_client, api_client, registry)
+    return registry.selected()
+
+def _boot():
+    global device_ids
+    try:
+        device_ids = start_system(fresh=False)
+        boot["ready"], boot["stage"], boot["ready_at"] = True, "running", time.time()
+        print(f"[gti] ready after {boot['ready_at'] - boot['t0']:.2f}s")
+    except Exception as e:
+        boot["stage"], boot["error"] = "failed", str(e)
+        print("[gti] boot failed:", e)
 
-    coordinator = Coordinator(mqtt_client, opt.get("mqtt_prefix","homeassistant"), opt, api_client)
-    t = threading.Thread(target=coordinator.loop, args=(dids,), daemon=True)
-    t.start()
-    print("[gti] Started coordinator with devices:", dids)
-    return dids
+# không chặn import: port được bind ngay, các subsystem khởi động trong thread nền
+restore_from_cache()
 
-device_ids = start_system()
+@app.on_event("startup")
+def _start_boot():
+    threading.Thread(target=_boot, daemon=True).start()
+
+def _command_router():
+    return coordinator.commands if coordinator is not None else web_commands
+
+def _state_source():
+    return coordinator or state_store
+
+def _state_cache() -> Dict:
+    src = _state_source()
+    return src.state_cache if src else {}
 
 def render(tpl, **ctx):
-    template = env.get_template(tpl)
+    template = templates.get(tpl) or env.get_template(tpl)
     return HTMLResponse(template.render(**ctx))
 
+# version counter là của từng process: web_workers (run_mode split) khởi động cùng giây vẫn
+# khác pid -> ETag của worker này không bao giờ khớp trang worker khác đã render
+_BOOT = f"{os.getpid()}-{int(time.time())}"
+view_cache = ViewCache()
+_render_lock = threading.Lock()
+_render_cache: "OrderedDict[Tuple, Tuple[str, str]]" = OrderedDict()
+_schedules_cache: Dict[str, Tuple[float, int, Dict]] = {}  # device -> (ts, version, data)
+
+def _schedules(device_id: str) -> Tuple[int, Dict]:
+    cur = _schedules_cache.get(device_id)
+    if cur and time.time() - cur[0] < SCHEDULES_TTL:
+        return cur[1], cur[2]
+    try:
+        with api_client.priority(PRIO_UI):
+            data = api_client.get_schedules(device_id) or {}
+    except RateLimited:
+        # hết ngân sách: dùng lại bản cũ (nếu có), thử lại ở lần xem sau
+        return (cur[1], cur[2]) if cur else (0, {})
+    ver = (cur[1] + 1) if cur else 1
+    _schedules_cache[device_id] = (time.time(), ver, data)
+    return ver, data
+
+@app.get("/api/fleet/summary")
+def fleet_summary():
+    fa = getattr(_state_source(), "analytics", None)
+    if fa is None:
+        return JSONResponse({"error": "fleet analytics unavailable"}, status_code=503)
+    return JSONResponse(fa.summary())
+
+# đọc trực tiếp /data/history (poller ghi), dùng được ở cả vai trò web
+history = history_store.HistoryStore()
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv", history_store.export_csv),
+    "influx": ("text/plain; charset=utf-8", "lp", history_store.export_influx),
+    "parquet": ("application/vnd.apache.parquet", "parquet", history_store.export_parquet),
+}
+
+def _ts_param(v, default: float) -> float:
+    """Epoch giây hoặc ISO 8601; ISO không có múi giờ coi là UTC như history_store."""
+    if v is None or v == "":
+        return default
+    try:
+        ts = float(v)
+    except ValueError:
+        dt = isoparse(v)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        ts = dt.timestamp()
+    if not math.isfinite(ts):
+        # nan/inf lọt qua float() rồi nổ giữa chừng trong generator đang stream
+        raise ValueError(f"non-finite timestamp {v!r}")
+    datetime.fromtimestamp(ts, tz=timezone.utc)  # ngoài khoảng năm hợp lệ -> lỗi ở đây, không phải giữa stream
+    return ts
+
+@app.get("/api/export")
+def export(device_id: str = "all", format: str = "csv",
+           from_: Optional[str] = Query(None, alias="from"), to: Optional[str] = None):
+    """Stream lịch sử theo khối (bộ nhớ không đổi theo độ dài khoảng thời gian)."""
+    fmt = EXPORT_FORMATS.get(format)
+    if fmt is None:
+        raise HTTPException(400, "format must be csv, parquet or influx")
+    if format == "parquet" and not history_store.parquet_available():
+        raise HTTPException(501, "parquet export requires pyarrow")
+    try:
+        t_to = _ts_param(to, time.time())
+        t_from = _ts_param(from_, t_to - 86400)
+    except (ValueError, OverflowError, OSError):
+        raise HTTPException(400, "from/to must be epoch seconds or ISO 8601")
+    if device_id == "all":
+        dids = history.devices()
+    else:
+        dids = [(registry.resolve(device_id) if registry else None) or normalize_did(device_id)]
+    media, ext, encoder = fmt
+    name = f"gti_{history_store._safe(device_id)}_{int(t_from)}_{int(t_to)}.{ext}"
+    return StreamingResponse(encoder(history, dids, t_from, t_to), media_type=media,
+                             headers={"Content-Disposition": f'attachment; filename="{name}"'})
+
+@app.get("/debug/profile")
+def debug_profile(seconds: float = 30, interval_ms: float = 10):
+    """Sampling profiler mọi thread của process này, trả folded stacks (flamegraph.pl / speedscope)."""
+    out = profiler.sample(seconds, interval_ms / 1000.0)
+    if out is None:
+        raise HTTPException(409, "another profile is running")
+    return Response(out, media_type="text/plain; charset=utf-8",
+                    headers={"Content-Disposition": f'attachment; filename="gti-{ROLE}-{os.getpid()}.folded"'})
+
+@app.get("/debug/slow_cycles")
+def debug_slow_cycles(limit: int = 20):
+    """Span trace của các vòng poll vượt slow_cycle_ms (mọi shard, mới nhất trước)."""
+    return JSONResponse({"cycles": profiler.recent_cycles(limit=limit)})
+
+@app.get("/debug/commands")
+def debug_commands(limit: int = 100):
+    """Độ trễ đầu-cuối của các lệnh setpoint gần nhất (mọi shard) + p50/p95 theo đường gửi."""
+    rows = commands.recent_commands(limit=limit)
+    router = _command_router()
+    return JSONResponse({"transport": router.transport if router else None,
+                         "summary": commands.summarize(rows), "commands": rows})
+
+def _ensure_login() -> bool:
+    try:
+        return api_client.login()
+    except Exception as e:
+        print("LOGIN error:", e)
+        return False
+
+def api_which():
+    ok = _ensure_login()
+    src = getattr(coordinator, "source", None)
+    return JSONResponse({
+        "login": ok,
+        "uid": api_client.uid,
+        "registry": [registry.get(d) for d in registry.ids()],
+        "selected": registry.selected(),
+        "server_base_url": api_client.base,
+        "device_suffixes": options.get("device_suffixes", ""),
+        "include_devices": options.get("include_devices", []),
+        "source": src.name if src else None,
+        "api_budget": api_client.limiter.snapshot(),
+    })
+
+def api_devices():
+    if not _ensure_login():
+        return JSONResponse({"error": "login failed"}, status_code=401)
+    with api_client.priority(PRIO_UI):
+        items = registry.reconcile()
+    return JSONResponse({"devices": items, "picked": registry.pick(), "uid": api_client.uid})
+
+def api_state(device_id: Optional[str] = Query(default=None, description="GTIControlXXX hoặc gtiXXX")):
+    if not _ensure_login():
+        return JSONResponse({"error": "login failed"}, status_code=401)
+    did = (registry.resolve(device_id) or normalize_did(device_id)) if device_id else registry.pick()
+    if not did:
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    try:
+        with api_client.priority(PRIO_UI):
+            st = api_client.read_state_server(did, peek=True)
+    except RateLimited:
+        return JSONResponse({"error": "rate limited"}, status_code=429)
+    if not st:
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    return JSONResponse(st)
+
+def api_fields(device_id: str):
+    """Giá trị / hợp lệ / tuổi (giây) từng trường trong DeviceState của coordinator."""
+    rec = coordinator.records.get(registry.resolve(device_id) or normalize_did(device_id)) if coordinator else None
+    if rec is None:
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    return JSONResponse({"device_id": rec.device_id, "online": rec.online, "fields": rec.fields_info()})
+
+if VARIANT == "debug":
+    app.get("/api/fields")(api_fields)
+    app.get("/api/which")(api_which)
+    app.get("/api/devices")(api_devices)
+    app.get("/api/state")(api_state)
+
 @app.get("/", response_class=HTMLResponse)
 def home():
     return RedirectResponse(url="/app/login")
@@ -95,44 +362,78 @@ async def do_login(req: Request):
     opt["password"] = password
     with open(ADDON_OPTIONS_PATH, "w", encoding="utf-8") as f:
         json.dump(opt, f, ensure_ascii=False, indent=2)
-    start_system()
+    await run_in_threadpool(start_system)
     return RedirectResponse(url="/app/devices", status_code=302)
 
 @app.get("/app/devices", response_class=HTMLResponse)
 def devices_page():
-    return render("devices.html", devices=device_ids)
+    if registry:
+        registry.refresh()
+    return render("devices.html", devices=(registry.selected() if registry else device_ids))
 
 @app.get("/app/device/{device_id}", response_class=HTMLResponse)
-def device_detail(device_id: str, tab: str = "stats"):
-    st = (coordinator.state_cache.get(device_id, {}) if coordinator else {}) or {}
-    schedules = api_client.get_schedules(device_id) if (api_client and coordinator and coordinator.server_enabled) else {}
-    return render("device_detail.html",
-                  device_id=device_id, tab=tab,
-                  state=st, schedules=schedules,
-                  use_server_daily_monthly=(coordinator.use_server_daily_monthly if coordinator else False),
-                  server_enabled=(coordinator.server_enabled if coordinator else False))
+def device_detail(req: Request, device_id: str, tab: str = "stats"):
+    device_id = (registry.resolve(device_id) if registry else None) or device_id
+    src = _state_source()
+    version = src.versions.get(device_id, 0) if src else 0
+    server_enabled = bool(options.get("server_enabled", True))
+    sched_ver, schedules = 0, {}
+    if tab == "schedules" and api_client and server_enabled:
+        sched_ver, schedules = _schedules(device_id)
 
-@app.post("/app/device/{device_id}/set", response_class=HTMLResponse)
-async def device_set(device_id: str, req: Request):
-    if not coordinator or not coordinator.server_enabled:
-        raise HTTPException(400, "Server disabled")
-    form = await req.form()
+    key = (device_id, tab, version, sched_ver)
+    etag = f'W/"{_BOOT}-{device_id}-{tab}-{version}-{sched_ver}"'
+    if req.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    hit = _render_cache.get(key)
+    if hit is None:
+        st = _state_cache().get(device_id, {}) or {}
+        html = (templates.get("device_detail.html") or env.get_template("device_detail.html")).render(
+            device_id=device_id, tab=tab,
+            view=view_cache.get(device_id, version, st), schedules=schedules,
+            use_server_daily_monthly=bool(options.get("use_server_daily_monthly", True)),
+            server_enabled=server_enabled)
+        hit = (etag, html)
+        with _render_lock:
+            _render_cache[key] = hit
+            while len(_render_cache) > RENDER_CACHE_SIZE:
+                _render_cache.popitem(last=False)
+    return HTMLResponse(hit[1], headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+def _apply_setting(device_id: str, form) -> bool:
     action = form.get("action")
-    ok = False
-    try:
+    # cùng đường lệnh với HA (coordinator: MQTT thiết bị / REST dự phòng; role web: REST)
+    cmd = _command_router()
+    if cmd is None:
+        return False  # chưa boot xong
+    with api_client.priority(PRIO_COMMAND):
         if action == "cutoff":
             val = float(form.get("cutoff_voltage") or 0)
-            ok = api_client.set_cutoff_voltage(device_id, val)
-        elif action == "maxpower":
+            return cmd.set_cutoff_voltage(device_id, val)
+        if action == "maxpower":
             val = float(form.get("max_power_limit") or 0)
-            ok = api_client.set_max_power(device_id, val)
-        elif action and action.startswith("sched"):
+            return cmd.set_max_power(device_id, val)
+        if action and action.startswith("sched"):
             idx = int(action.replace("sched",""))
             start = form.get(f"schedule{idx}_start") or "00:00"
             end   = form.get(f"schedule{idx}_end") or "00:00"
             cv    = float(form.get(f"schedule{idx}_cutoff_voltage") or 0)
             mw    = float(form.get(f"schedule{idx}_max_power") or 0)
-            ok = api_client.set_schedule(device_id, idx, start, end, cv, mw)
+            ok = cmd.set_schedule(device_id, idx, start, end, cv, mw)
+            _schedules_cache.pop(device_id, None)
+            return ok
+    return False
+
+@app.post("/app/device/{device_id}/set", response_class=HTMLResponse)
+async def device_set(device_id: str, req: Request):
+    if not api_client or not options.get("server_enabled", True):
+        raise HTTPException(400, "Server disabled")
+    form = await req.form()
+    ok = False
+    try:
+        # lệnh có thể phải chờ ngân sách request -> không chặn event loop
+        ok = await run_in_threadpool(_apply_setting, device_id, form)
     except Exception:
         ok = False
     return RedirectResponse(url=f"/app/device/{device_id}?tab=settings", status_code=302)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Nơi nhận state từ Coordinator.
+- UiSink:    state_cache + versions (cache render của UI), fleet analytics, lịch sử export
+- HaMqttSink: discovery + gti/<device>/state lên broker HA, buffer khi mất kết nối,
+              nhận lệnh gti/<device>/cmd/... từ entity number/datetime,
+              trả độ trễ lệnh lên gti/<device>/cmd/result (commands.CommandRouter)
+"""
+
+from __future__ import annotations
+
+import json, threading
+from typing import Any, Callable, Dict, Optional
+
+from paho.mqtt.client import Client, MQTT_ERR_SUCCESS
+
+from mapping import GTI_SENSORS, GRID_SENSORS, TIEUTHU_SENSORS, FLEET_SENSORS
+from mqtt_discovery import publish_sensor, publish_binary_sensor, publish_number, publish_datetime, publish_alert, \
+    publish_command_latency
+from anomaly_detector import ALERTS
+
+CMD_TOPICS = ("gti/+/cmd/number/+", "gti/+/cmd/datetime/+")
+
+# on_command(device_id, kind ("number"|"datetime"), key, payload)
+CommandHandler = Callable[[str, str, str, str], None]
+
+
+class UiSink:
+    def __init__(self, analytics=None, history=None) -> None:
+        self.state_cache: Dict[str, Dict[str, Any]] = {}
+        self.versions: Dict[str, int] = {}  # tăng mỗi lần publish -> UI cache theo version
+        self.analytics = analytics  # FleetAnalytics (nếu có numpy)
+        self.history = history      # HistoryStore: lưu mẫu cho /api/export
+
+    def publish_state(self, device_id: str, st: Dict[str, Any], payload: Optional[str] = None) -> None:
+        # chỉ lưu lịch sử mẫu mới (không lưu state cũ bị đánh offline)
+        if st.get("online") and self.history is not None:
+            try:
+                self.history.append(device_id, st)
+            except OSError as e:
+                print("[sink] history write error:", e)
+        self.state_cache[device_id] = st
+        self.versions[device_id] = self.versions.get(device_id, 0) + 1
+        if self.analytics:
+            self.analytics.update(device_id, st)
+
+
+class HaMqttSink:
+    def __init__(self, client: Client, prefix: str, buffer=None, replay_rate: float = 20.0,
+                 replay_collapse: bool = True) -> None:
+        self.client = client
+        self.prefix = prefix
+        self.buffer = buffer  # OfflineBuffer: giữ state khi broker HA mất kết nối
+        self.replay_rate = replay_rate
+        self.replay_collapse = replay_collapse
+        self.fleet = False  # coordinator thấy cả fleet -> discovery/publish gti/fleet/state
+        self._discovered: set = set()
+        self._dropped = 0  # message bỏ do không ghi được buffer
+
+    # ---------------- discovery ----------------
+    def _device_info(self, device_id: str) -> Dict[str, Any]:
+        return {
+            "identifiers": [f"gti:{device_id}"],
+            "name": device_id,
+            "manufacturer": "GTI",
+            "model": "GTI Control"
+        }
+
+    def discover(self, device_id: str) -> None:
+        self._discovered.add(device_id)
+        info = self._device_info(device_id)
+        for k, meta in {**GTI_SENSORS, **GRID_SENSORS, **TIEUTHU_SENSORS}.items():
+            publish_sensor(self.client, self.prefix, device_id, k, meta, info)
+        publish_binary_sensor(self.client, self.prefix, device_id, info)
+        for k, name in ALERTS.items():
+            publish_alert(self.client, self.prefix, device_id, k, name, info)
+        publish_number(self.client, self.prefix, device_id, "cutoff_voltage", "Điện áp ngắt", "V", 0, 100, 0.1, info)
+        publish_number(self.client, self.prefix, device_id, "max_power_limit", "Công suất giới hạn", "W", 0, 5000, 10, info)
+        for i in [1,2,3]:
+            publish_datetime(self.client, self.prefix, device_id, f"schedule{i}_start", f"Lịch {i} - Bắt đầu", info)
+            publish_datetime(self.client, self.prefix, device_id, f"schedule{i}_end",   f"Lịch {i} - Kết thúc", info)
+            publish_number(self.client, self.prefix, device_id, f"schedule{i}_cutoff_voltage", f"Lịch {i} - Điện áp ngắt", "V", 0, 100, 0.1, info)
+            publish_number(self.client, self.prefix, device_id, f"schedule{i}_max_power", f"Lịch {i} - Công suất", "W", 0, 5000, 10, info)
+        publish_command_latency(self.client, self.prefix, device_id, info)
+
+    def discovered(self, device_id: str) -> bool:
+        return device_id in self._discovered
+
+    def discover_fleet(self) -> None:
+        info = {"identifiers": ["gti:fleet"], "name": "GTI Fleet", "manufacturer": "GTI", "model": "GTI Control"}
+        for k, meta in FLEET_SENSORS.items():
+            publish_sensor(self.client, self.prefix, "fleet", k, meta, info)
+
+    # ---------------- publish ----------------
+    def _send(self, topic: str, payload: str, retain: bool = False) -> bool:
+        if self.client is None or not self.client.is_connected():
+            return False
+        return self.client.publish(topic, payload, retain=retain).rc == MQTT_ERR_SUCCESS
+
+    def _buffer(self, topic: str, payload: str, retain: bool) -> None:
+        # /data đầy / lỗi ghi: bỏ message, không để lỗi thoát ra làm chết thread coordinator
+        try:
+            self.buffer.append(topic, payload, retain)
+        except OSError as e:
+            self._dropped += 1
+            if self._dropped == 1 or self._dropped % 100 == 0:
+                print(f"[sink] offline buffer write error ({self._dropped} dropped):", e)
+
+    def publish(self, topic: str, payload: str, retain: bool = False) -> None:
+        """Broker mất kết nối (hoặc đang replay) thì xếp vào buffer trên đĩa."""
+        if self.buffer is not None and self.buffer.replaying:
+            self._buffer(topic, payload, retain)
+            return
+        if self._send(topic, payload, retain):
+            return
+        if self.buffer is not None:
+            self._buffer(topic, payload, retain)
+
+    def publish_state(self, device_id: str, st: Dict[str, Any], payload: Optional[str] = None) -> None:
+        """payload: JSON đã serialize sẵn (DeviceState.to_json), không có thì dumps st."""
+        self.publish(f"gti/{device_id}/state", payload or json.dumps(st), retain=True)
+
+    def publish_command_result(self, device_id: str, result: Dict[str, Any]) -> None:
+        # không retain, không buffer: độ trễ cũ replay lại sau khi mất kết nối không có ý nghĩa
+        self._send(f"gti/{device_id}/cmd/result", json.dumps(result))
+
+    def publish_fleet(self, state: Dict[str, Any]) -> None:
+        self.publish("gti/fleet/state", json.dumps(state), retain=True)
+
+    # ---------------- kết nối / lệnh ----------------
+    def _replay(self) -> None:
+        if self.buffer is not None:
+            self.buffer.replay(self._send, rate=self.replay_rate, collapse=self.replay_collapse)
+
+    def _on_connect(self, client, userdata, flags, rc) -> None:
+        if rc != 0:
+            return
+        print("[sink] MQTT connected")
+        for t in CMD_TOPICS:
+            client.subscribe(t)
+        # broker có thể đã mất retained config -> discovery lại, rồi replay state đã buffer
+        for d in list(self._discovered):
+            self.discover(d)
+        if self.fleet:
+            self.discover_fleet()
+        self._replay()
+
+    def attach(self, on_command: Optional[CommandHandler] = None) -> None:
+        if self.client is None:
+            return
+        if on_command is not None:
+            def _cmd(client, userdata, msg):
+                parts = msg.topic.split("/")  # gti/<device>/cmd/<kind>/<key>
+                if len(parts) != 5:
+                    return
+                payload = msg.payload.decode("utf-8", "replace").strip()
+                # lệnh có thể phải chờ ngân sách request -> không chặn network thread của paho
+                threading.Thread(target=on_command, args=(parts[1], parts[3], parts[4], payload),
+                                 daemon=True).start()
+            for t in CMD_TOPICS:
+                self.client.message_callback_add(t, _cmd)
+        self.client.on_connect = self._on_connect
+        if self.client.is_connected():
+            for t in CMD_TOPICS:
+                self.client.subscribe(t)
+            self._replay()
+        if self.fleet:
+            self.discover_fleet()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+State có kiểu cho từng device, thay cho dict trộn payload thô + số đã chuẩn hoá.
+- Thứ tự trường cố định lấy từ mapping.py; giá trị lưu trong array('d'), làm tròn 2 số khi publish
+- Mỗi trường có cờ hợp lệ (valid) và thời điểm đọc hợp lệ gần nhất (age = now - stamp)
+- Chuẩn hoá 1 lượt, không dùng try/except: số / chuỗi số hữu hạn -> float, còn lại -> 0.0 + invalid
+- snapshot() / to_json() tạo bản sao khi publish; record không bao giờ bị sink sửa tại chỗ
+"""
+
+from __future__ import annotations
+
+import math, re, time
+from array import array
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
+
+from mapping import GTI_SENSORS, GRID_SENSORS, TIEUTHU_SENSORS, DAILY_KEYS, MONTHLY_KEYS
+
+INSTANT_FIELDS: Tuple[str, ...] = tuple(GTI_SENSORS) + tuple(GRID_SENSORS) + tuple(TIEUTHU_SENSORS)
+PERIOD_FIELDS: Tuple[str, ...] = tuple(DAILY_KEYS) + tuple(MONTHLY_KEYS)
+
+_NUM = re.compile(r"\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\s*\Z")
+_isfinite = math.isfinite
+
+
+def to_float(x: Any) -> Optional[float]:
+    """Số hữu hạn (float/int/chuỗi số) -> float; bool, None, NaN, inf, chuỗi rác -> None."""
+    t = type(x)
+    if t is float:
+        return x if _isfinite(x) else None
+    if t is int:
+        return float(x)
+    if t is str and _NUM.match(x):
+        v = float(x)
+        return v if _isfinite(v) else None
+    return None
+
+
+class Layout:
+    """Danh sách trường cố định (dùng chung cho mọi record của 1 coordinator)."""
+    __slots__ = ("fields", "index", "_pairs", "_json")
+
+    def __init__(self, fields: Iterable[str]) -> None:
+        self.fields = tuple(fields)
+        self.index = {k: i for i, k in enumerate(self.fields)}
+        self._pairs: Dict[Tuple[str, ...], Tuple[Tuple[str, int], ...]] = {}
+        # làm tròn 2 số ngay khi format (C), không round() từng trường
+        self._json = "{" + ", ".join(f'"{k}": %.2f' for k in self.fields)
+
+    def pairs(self, fields: Optional[Tuple[str, ...]]) -> Tuple[Tuple[str, int], ...]:
+        fields = self.fields if fields is None else fields
+        p = self._pairs.get(fields)
+        if p is None:
+            p = self._pairs[fields] = tuple((k, self.index[k]) for k in fields)
+        return p
+
+
+class DeviceState:
+    __slots__ = ("device_id", "layout", "values", "valid", "stamp", "online", "flags", "updated")
+
+    def __init__(self, device_id: str, layout: Layout) -> None:
+        n = len(layout.fields)
+        self.device_id = device_id
+        self.layout = layout
+        self.values = array("d", bytes(8 * n))
+        self.valid = bytearray(n)
+        self.stamp = array("d", bytes(8 * n))
+        self.online = False
+        self.flags: Dict[str, bool] = {}  # alert_* từ AnomalyDetector
+        self.updated = 0.0
+
+    def update(self, src: Mapping[str, Any], fields: Optional[Tuple[str, ...]] = None,
+               now: Optional[float] = None) -> None:
+        """Nạp các trường `fields` (mặc định: tất cả) từ dict nguồn; thiếu/không hợp lệ -> 0.0."""
+        now = time.time() if now is None else now
+        values, valid, stamp = self.values, self.valid, self.stamp
+        get = src.get
+        # to_float() viết inline: vòng nóng, mỗi device x mỗi trường x mỗi vòng poll
+        for k, i in self.layout.pairs(fields):
+            v = get(k)
+            t = type(v)
+            if t is float:
+                ok = v - v == 0.0  # False với NaN/inf
+            elif t is int:
+                v, ok = float(v), True
+            elif t is str and _NUM.match(v):
+                v = float(v)
+                ok = v - v == 0.0
+            else:
+                ok = False
+            if ok:
+                values[i] = v
+                valid[i] = 1
+                stamp[i] = now
+            else:
+                values[i] = 0.0
+                valid[i] = 0
+        self.updated = now
+
+    def get(self, key: str, default: float = 0.0) -> float:
+        i = self.layout.index.get(key)
+        return default if i is None else self.values[i]
+
+    def age(self, key: str, now: Optional[float] = None) -> Optional[float]:
+        """Giây kể từ lần đọc hợp lệ gần nhất của trường; None nếu chưa từng hợp lệ."""
+        i = self.layout.index[key]
+        if not self.stamp[i]:
+            return None
+        return (time.time() if now is None else now) - self.stamp[i]
+
+    def fields_info(self, now: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+        now = time.time() if now is None else now
+        return {k: {"value": self.values[i], "valid": bool(self.valid[i]),
+                    "age": round(now - self.stamp[i], 1) if self.stamp[i] else None}
+                for k, i in self.layout.index.items()}
+
+    # ---------------- publish (bản sao) ----------------
+    def snapshot(self) -> Dict[str, Any]:
+        """Bản sao dict cho UI / lịch sử / detector (đủ độ chính xác; UI tự format 2 số)."""
+        st: Dict[str, Any] = dict(zip(self.layout.fields, self.values))
+        st["online"] = self.online
+        st.update(self.flags)
+        return st
+
+    def to_json(self) -> str:
+        """Payload MQTT ghép thẳng từ array bằng 1 phép format, làm tròn 2 số như fmt2 trước đây."""
+        tail = ', "online": ' + ("true" if self.online else "false")
+        for k, v in self.flags.items():
+            tail += f', "{k}": ' + ("true" if v else "false")
+        return self.layout._json % tuple(self.values) + tail + "}"
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+State cho web tier khi chạy run_mode "split" (UiSink nạp từ MQTT): không có coordinator trong process,
+đọc state từ các topic retained gti/<device>/state mà poller đã publish.
+"""
+
+from __future__ import annotations
+
+import json
+
+from paho.mqtt.client import Client
+
+import fleet_analytics
+from sinks import UiSink
+
+STATE_TOPIC = "gti/+/state"
+
+
+class StateStore(UiSink):
+    def __init__(self, mqtt_client: Client) -> None:
+        super().__init__(fleet_analytics.FleetAnalytics() if fleet_analytics.available() else None)
+        self.client = mqtt_client
+
+    def _on_state(self, client, userdata, msg) -> None:
+        parts = msg.topic.split("/")
+        if len(parts) != 3 or parts[1] == "fleet":
+            return
+        try:
+            st = json.loads(msg.payload.decode("utf-8") or "{}")
+        except Exception:
+            return
+        if isinstance(st, dict):
+            self.publish_state(parts[1], st)
+
+    def attach(self) -> None:
+        if not self.client:
+            return
+        self.client.message_callback_add(STATE_TOPIC, self._on_state)
+        # subscribe lại mỗi lần (re)connect để nhận lại các bản retained
+        self.client.on_connect = lambda c, u, f, rc: c.subscribe(STATE_TOPIC)
+        self.client.subscribe(STATE_TOPIC)
+        self.client.loop_start()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+View model cho UI: format sẵn giá trị ("%.2f") 1 lần cho mỗi phiên bản state,
+template chỉ việc in chuỗi thay vì gọi filter format cho từng ô.
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import Any, Dict, Tuple
+
+from mapping import GTI_SENSORS, GRID_SENSORS, TIEUTHU_SENSORS, DAILY_KEYS, MONTHLY_KEYS
+
+VIEW_KEYS = (list(GTI_SENSORS) + list(GRID_SENSORS) + list(TIEUTHU_SENSORS)
+             + DAILY_KEYS + MONTHLY_KEYS
+             + [f"schedule{i}_{k}" for i in (1, 2, 3) for k in ("cutoff_voltage", "max_power")])
+
+
+def f2(x: Any) -> str:
+    try:
+        return "%.2f" % float(x)
+    except (TypeError, ValueError):
+        return "0.00"
+
+
+def build_view(state: Dict[str, Any]) -> Dict[str, Any]:
+    view: Dict[str, Any] = {k: f2(state.get(k, 0)) for k in VIEW_KEYS}
+    view["online"] = bool(state.get("online", False))
+    return view
+
+
+class ViewCache:
+    """Giữ view model mới nhất theo device, chỉ build lại khi version state đổi."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._views: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+
+    def get(self, device_id: str, version: int, state: Dict[str, Any]) -> Dict[str, Any]:
+        cur = self._views.get(device_id)
+        if cur and cur[0] == version:
+            return cur[1]
+        view = build_view(state)
+        with self._lock:
+            self._views[device_id] = (version, view)
+        return view
@@ -1,5 +1,38 @@
 #!/bin/sh
 set -e
 export PYTHONPATH=/app:${PYTHONPATH}
-echo "[gti] starting GTI Control (uvicorn) on 0.0.0.0:8099"
+
+opt() {
+  /opt/venv/bin/python -c "import json,sys; print(json.load(open('/data/options.json')).get(sys.argv[1], sys.argv[2]))" "$1" "$2" 2>/dev/null || echo "$2"
+}
+
+RUN_MODE=$(opt run_mode single)
+# bản debug không chạy poller (server.py ép GTI_ROLE=web): bỏ qua run_mode split
+if [ "$RUN_MODE" = "split" ] && [ "$GTI_VARIANT" != "debug" ]; then
+  SHARDS=$(opt poller_shards 1)
+  WORKERS=$(opt web_workers 1)
+  i=0
+  while [ "$i" -lt "$SHARDS" ]; do
+    # mỗi shard có vòng giám sát riêng: poller thoát/crash (lock được nhả) -> chạy lại sau 5s,
+    # web không phải phục vụ state retained cũ mãi
+    (
+      while true; do
+        echo "[gti] starting poller shard $i/$SHARDS"
+        code=0
+        /opt/venv/bin/python /app/poller.py --shard "$i" --shards "$SHARDS" || code=$?
+        echo "[gti] poller shard $i/$SHARDS exited ($code), restarting in 5s"
+        sleep 5
+      done
+    ) &
+    i=$((i + 1))
+  done
+  echo "[gti] starting GTI Control web (uvicorn, $WORKERS workers) on 0.0.0.0:8099"
+  export GTI_ROLE=web
+  exec /opt/venv/bin/python -m uvicorn server:app --host 0.0.0.0 --port 8099 --workers "$WORKERS"
+fi
+
+echo "[gti] starting GTI Control (uvicorn, ${GTI_VARIANT:-ingress}) on 0.0.0.0:8099"
+if [ "$GTI_VARIANT" = "debug" ]; then
+  exec /opt/venv/bin/python -m uvicorn server:app --host 0.0.0.0 --port 8099 --reload --log-level debug
+fi
 exec /opt/venv/bin/python -m uvicorn server:app --host 0.0.0.0 --port 8099
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Đồng bộ core dùng chung từ gti-control sang các add-on khác.
+Mỗi add-on là 1 Docker build context riêng (không COPY được ../), nên code chung
+được chép nguyên vào từng add-on; bản gốc DUY NHẤT là gti-control/.
+  python scripts/sync_core.py          # chép app/, run.sh, Dockerfile, requirements.txt
+  python scripts/sync_core.py --check  # chỉ kiểm tra, exit 1 nếu có file lệch (dùng trước commit/CI)
+Khác biệt giữa các add-on chỉ nằm ở config.json (tên, slug, ingress/port, GTI_VARIANT).
+"""
+
+from __future__ import annotations
+
+import argparse, filecmp, os, shutil, sys
+from typing import List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORE = "gti-control"
+TARGETS = ["gti-control-debug"]
+SHARED = ["app", "run.sh", "Dockerfile", "requirements.txt"]
+IGNORE = ("__pycache__",)
+
+
+def _files(base: str) -> List[str]:
+    out = []
+    for item in SHARED:
+        p = os.path.join(base, item)
+        if os.path.isfile(p):
+            out.append(item)
+            continue
+        for d, dirs, names in os.walk(p):
+            dirs[:] = [x for x in dirs if x not in IGNORE]
+            for n in names:
+                if not n.endswith((".pyc", ".pyo")):
+                    out.append(os.path.relpath(os.path.join(d, n), base))
+    return sorted(out)
+
+
+def diff(target: str) -> Tuple[List[str], List[str]]:
+    """(file cần chép/ghi đè, file thừa cần xoá) của 1 add-on so với core."""
+    src, dst = os.path.join(ROOT, CORE), os.path.join(ROOT, target)
+    want = _files(src)
+    stale = sorted(set(_files(dst)) - set(want))
+    changed = [f for f in want if not (os.path.exists(os.path.join(dst, f))
+                                       and filecmp.cmp(os.path.join(src, f), os.path.join(dst, f), shallow=False))]
+    return changed, stale
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--check", action="store_true", help="không ghi, exit 1 nếu lệch")
+    args = ap.parse_args()
+
+    drift = False
+    for target in TARGETS:
+        changed, stale = diff(target)
+        for f in changed:
+            print(f"{target}/{f}: {'differs from' if args.check else 'updated from'} {CORE}")
+            if not args.check:
+                dst = os.path.join(ROOT, target, f)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(os.path.join(ROOT, CORE, f), dst)
+        for f in stale:
+            print(f"{target}/{f}: {'not in' if args.check else 'removed, not in'} {CORE}")
+            if not args.check:
+                os.remove(os.path.join(ROOT, target, f))
+        drift = drift or bool(changed or stale)
+    return 1 if (args.check and drift) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())